@@ -0,0 +1,113 @@
+import collections
+import time
+
+# rates are snippets per second, bursts how many can be spent at once, 0 turns a limit off
+DEFAULT_LIMITS = {
+    "user_rate": 0.5,
+    "user_burst": 5,
+    "channel_rate": 2.0,
+    "channel_burst": 10,
+    "guild_rate": 5.0,
+    "guild_burst": 30,
+    # snippets admitted and not finished yet (queued, running or being answered)
+    "max_inflight": 50,
+    # shed once this many are waiting for a worker
+    "max_queue": 30,
+}
+
+# buckets kept per scope, least recently used ones are forgotten (and start full again)
+MAX_BUCKETS = 10000
+
+
+class Busy(Exception):
+    """Snippet refused before it cost anything, notify says whether it's worth telling the user"""
+
+    def __init__(self, reason, notify=True):
+        super().__init__(reason)
+        self.notify = notify
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # told the user they're limited already, don't spam them about it
+        self.warned = False
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.warned = False
+            return True
+        return False
+
+    def retry_after(self):
+        return (1 - self.tokens) / self.rate if self.rate else 0.0
+
+
+class Admission:
+    """Token buckets per user, channel and guild plus a global cap, so bursts can't pile up work in the bot"""
+
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        # scope -> key -> bucket, oldest first
+        self.buckets = {scope: collections.OrderedDict() for scope in ("user", "channel", "guild")}
+        self.inflight = 0
+        self.shed = collections.Counter()
+
+    def configure(self, name, value):
+        """Change one limit while running, buckets pick it up on their next use"""
+        if name not in DEFAULT_LIMITS:
+            raise KeyError(name)
+        if value < 0:
+            raise ValueError("limits can't be negative")
+        self.limits[name] = int(value) if name.startswith("max_") else value
+        if name.endswith("_rate") or name.endswith("_burst"):
+            # rebuilt with the new numbers as they're needed
+            self.buckets[name.split("_")[0]].clear()
+
+    def _bucket(self, scope, key):
+        rate = self.limits[f"{scope}_rate"]
+        if not rate:
+            return None
+        buckets = self.buckets[scope]
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, max(1, self.limits[f"{scope}_burst"]))
+            if len(buckets) > MAX_BUCKETS:
+                buckets.popitem(last=False)
+        buckets.move_to_end(key)
+        return bucket
+
+    def enter(self, user_id, channel_id, guild_id, queued):
+        """Let a snippet in or raise Busy, every successful enter needs a leave"""
+        max_inflight = self.limits["max_inflight"]
+        if max_inflight and self.inflight >= max_inflight:
+            self.shed["inflight"] += 1
+            raise Busy("The bot is busy")
+        max_queue = self.limits["max_queue"]
+        if max_queue and queued >= max_queue:
+            self.shed["queue"] += 1
+            raise Busy(f"{queued} snippets are already waiting")
+
+        for scope, key in (("user", user_id), ("channel", channel_id), ("guild", guild_id)):
+            bucket = self._bucket(scope, key)
+            if bucket is not None and not bucket.take():
+                self.shed[scope] += 1
+                notify = not bucket.warned
+                bucket.warned = True
+                who = {"user": "You are", "channel": "This channel is", "guild": "This server is"}[scope]
+                raise Busy(f"{who} running code too fast, wait {bucket.retry_after():.0f}s", notify)
+
+        self.inflight += 1
+
+    def leave(self):
+        self.inflight -= 1
+
+    def stats(self):
+        return {"inflight": self.inflight, "shed": dict(self.shed), "limits": dict(self.limits)}
@@ -0,0 +1,345 @@
+"""Offline load test for the message pipeline, no Discord token or podman needed
+
+Synthetic messages go through bot.on_message with a fake channel that just records replies.
+The executor is either real warm workers running locally (--executor real), forkservers forking a child
+per snippet (--executor fork) or a stub that answers instantly over the same protocol (--executor stub),
+which leaves only the bot's own overhead. --engine luajit runs the corpus on LuaJIT instead.
+
+    python bench.py --executor real --concurrency 8 --messages 400 --save before.json
+    python bench.py --executor real --concurrency 8 --messages 400 --compare before.json
+    python bench.py --executor real --engine luajit --compare before.json
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+# keep the bot from touching real files or ports while it is benchmarked
+os.environ.setdefault('RESPONSES_FILE', ':memory:')
+os.environ.setdefault('PREAMBLES_FILE', ':memory:')
+os.environ.setdefault('METRICS_PORT', '0')
+
+import bot  # noqa: E402
+from executor import WorkerPool, ResultCache, start_process, STREAM_LIMIT, FRAME  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# fixed so runs stay comparable, (kind, code)
+CORPUS = [
+    ("cpu", "local s = 0 for i = 1, 200000 do s = s + i % 7 end return s"),
+    ("cpu", "local function fib(n) if n < 2 then return n end return fib(n-1) + fib(n-2) end return fib(20)"),
+    ("cpu", "local t = {} for i = 1, 5000 do t[i] = (i * 7919) % 1000 end table.sort(t) return t[2500]"),
+    ("cpu", "local s = {} for i = 1, 2000 do s[#s+1] = string.format('%04d', i) end return #table.concat(s)"),
+    ("print", "for i = 1, 200 do print('line', i) end"),
+    ("print", "for i = 1, 2000 do print(string.rep('x', 40)) end"),
+    ("print", "print('hello world')"),
+    ("print", "for i = 1, 50 do print(i, i * i, i * i * i) end"),
+    ("error", "error('something went wrong')"),
+    ("error", "local t = nil return t.x"),
+    ("error", "return 1 + {}"),
+    ("error", "local function f(n) return f(n + 1) + 1 end return f(1)"),
+    ("expression", "1 + 1"),
+    ("expression", "math.sqrt(2) * math.pi"),
+    ("expression", "string.upper('lua') .. string.rep('!', 3)"),
+    ("expression", "#'some string'"),
+]
+
+# the ways a snippet shows up in a message
+FORMATS = ["~~{}", "%`{}`", "%```lua\n{}\n```"]
+
+
+class FakeResponse:
+    """What the bot keeps of its own reply: id, edit and delete"""
+
+    ids = itertools.count(10 ** 12)
+
+    def __init__(self, channel, embed):
+        self.id = next(self.ids)
+        self.channel = channel
+        self.embed = embed
+        channel.messages[self.id] = self
+
+    async def edit(self, embed=None, attachments=()):
+        self.channel.edits += 1
+        self.embed = embed
+        return self
+
+    async def delete(self):
+        self.channel.messages.pop(self.id, None)
+
+
+class FakeChannel:
+    """Reply sink, remembers the last embed per response"""
+
+    def __init__(self):
+        self.id = 1
+        self.messages = {}
+        self.replies = 0
+        self.edits = 0
+
+    def get_partial_message(self, message_id):
+        return self.messages.get(message_id) or FakeResponse(self, None)
+
+
+class FakeUser:
+    bot = False
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeMessage:
+    """Just enough of discord.Message for on_message"""
+
+    ids = itertools.count(1)
+
+    def __init__(self, content, channel, author, guild):
+        self.id = next(self.ids)
+        self.content = content
+        self.channel = channel
+        self.author = author
+        self.guild = guild
+
+    async def reply(self, embed=None, file=None):
+        self.channel.replies += 1
+        return FakeResponse(self.channel, embed)
+
+
+class StubProcess:
+    """Speaks the worker protocol in-process and answers every snippet after `delay` seconds"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.returncode = None
+        self.stdout = asyncio.StreamReader(limit=STREAM_LIMIT)
+        self.stdin = self
+        self.tasks = set()
+
+    def write(self, data):
+        for line in data.splitlines():
+            request = json.loads(line)
+            if "code" in request:
+                task = asyncio.create_task(self._answer(request))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def _answer(self, request):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        failed = "error" in request["code"]
+        output = b"" if failed else b"stub"
+        result = {"id": request["id"], "status": "error" if failed else "ok", "output_size": len(output),
+                  "error": "stub error" if failed else None, "error_line": None, "values": [], "form": "statement",
+                  "budget": None, "truncated": False, "output_bytes": len(output), "elapsed": 0.0, "memory": 0}
+        header = json.dumps(result).encode()
+        self.stdout.feed_data(FRAME.pack(len(header), len(output)) + header + output)
+
+    async def drain(self):
+        pass
+
+    def kill(self):
+        self.returncode = -9
+        for task in self.tasks:
+            task.cancel()
+        self.stdout.feed_eof()
+
+    async def wait(self):
+        return self.returncode
+
+
+def rss_mb():
+    """Resident memory right now, falls back to the peak where /proc isn't around"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+def setup(args):
+    """Point the bot at a local executor instead of podman"""
+    async def container_ok():
+        return True
+    bot.container.ensure_running = container_ok
+    bot.ready.set()
+    bot.DEFAULT_ENGINE = args.engine
+    if not args.limits:
+        # measure the pipeline, not the rate limits
+        for name in bot.DEFAULT_LIMITS:
+            bot.admission.configure(name, 0)
+
+    # command parsing needs a logged in client, and none of the corpus messages are commands anyway
+    async def no_commands(message):
+        pass
+    bot.bot.process_commands = no_commands
+
+    if args.executor == "stub":
+        async def spawn():
+            return StubProcess(args.stub_delay)
+    else:
+        flag = "--forkserver" if args.executor == "fork" else "--server"
+
+        async def spawn():
+            return await start_process([sys.executable, os.path.join(HERE, "run_lua.py"), flag])
+
+    # queue limits are about fairness between real users, here they'd only turn load into "queue full"
+    bot.pool = WorkerPool(spawn, args.workers, args.messages, args.messages, bot.metrics.observe)
+    if not args.cache:
+        # the corpus repeats, without this most runs would be cache hits
+        class NoCache(ResultCache):
+            async def run(self, key, execute):
+                return await super().run(None, execute)
+        bot.result_cache = NoCache()
+
+
+async def send_one(message, latencies, kinds, kind):
+    start = time.perf_counter()
+    await bot.on_message(message)
+    latencies.append(time.perf_counter() - start)
+    kinds.setdefault(kind, []).append(latencies[-1])
+
+
+async def run(args):
+    setup(args)
+    rng = random.Random(args.seed)
+    channel = FakeChannel()
+    users = [FakeUser(i) for i in range(1, args.users + 1)]
+    guilds = [FakeGuild(i) for i in range(1, args.guilds + 1)]
+
+    def make_message():
+        kind, code = rng.choice(CORPUS)
+        content = rng.choice(FORMATS).format(code)
+        return kind, FakeMessage(content, channel, rng.choice(users), rng.choice(guilds))
+
+    # first runs pay for starting workers, don't count them
+    await asyncio.gather(*(send_one(make_message()[1], [], {}, "warmup") for _ in range(args.workers * 2)))
+    bot.metrics.stages.clear()
+    bot.metrics.counters.clear()
+    gc.collect()
+    rss_before = rss_mb()
+
+    latencies = []
+    kinds = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def worker(kind, message):
+        async with semaphore:
+            await send_one(message, latencies, kinds, kind)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(*make_message()) for _ in range(args.messages)))
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    rss_after = rss_mb()
+    await bot.pool.stop()
+
+    return {
+        "executor": args.executor,
+        "engine": args.engine,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "messages": args.messages,
+        "seconds": elapsed,
+        "throughput": args.messages / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "rss_before_mb": rss_before,
+        "rss_after_mb": rss_after,
+        "rss_growth_mb": rss_after - rss_before,
+        # these should all stay flat however many messages went through
+        "leftover_tasks": len(bot.message_tasks) + len(bot.running_executions),
+        "kinds": {kind: {"p50_ms": percentile(v, 0.5) * 1000, "p95_ms": percentile(v, 0.95) * 1000, "n": len(v)}
+                  for kind, v in sorted(kinds.items())},
+        "stages": {stage: {"p50_ms": h.percentile(0.5) * 1000, "p95_ms": h.percentile(0.95) * 1000}
+                   for stage, h in sorted(bot.metrics.stages.items())},
+        "outcomes": {dict(labels)["outcome"]: value for (name, labels), value in bot.metrics.counters.items()
+                     if name == "executions_total"},
+    }
+
+
+def report(result, baseline=None):
+    """Print the numbers, next to the baseline's if there is one"""
+    def line(label, value, old, lower_is_better=True):
+        if old is None:
+            print(f"  {label:<24}{value:>12.2f}")
+            return
+        change = (value - old) / old * 100 if old else 0.0
+        better = change < 0 if lower_is_better else change > 0
+        mark = "" if abs(change) < 2 else (" better" if better else " worse")
+        print(f"  {label:<24}{value:>12.2f}{old:>12.2f}{change:>+9.1f}%{mark}")
+
+    print(f"{result['messages']} messages, {result['executor']} executor ({result.get('engine', 'lua')}), {result['workers']} workers, "
+          f"concurrency {result['concurrency']}")
+    if baseline:
+        print(f"  {'':<24}{'now':>12}{'baseline':>12}{'change':>10}")
+    old = baseline or {}
+    line("throughput (msg/s)", result["throughput"], old.get("throughput"), lower_is_better=False)
+    for key in ("p50_ms", "p95_ms", "p99_ms", "rss_growth_mb"):
+        line(key, result[key], old.get(key))
+
+    print("  per kind:")
+    for kind, stats in result["kinds"].items():
+        line(f"  {kind} p95_ms", stats["p95_ms"], old.get("kinds", {}).get(kind, {}).get("p95_ms"))
+    print("  per stage:")
+    for stage, stats in result["stages"].items():
+        line(f"  {stage} p95_ms", stats["p95_ms"], old.get("stages", {}).get(stage, {}).get("p95_ms"))
+    print(f"  outcomes: {', '.join(f'{n} {o}' for o, n in sorted(result['outcomes'].items()))}")
+    print(f"  rss {result['rss_before_mb']:.1f} -> {result['rss_after_mb']:.1f} MB, "
+          f"leftover tasks {result['leftover_tasks']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--executor", choices=["real", "fork", "stub"], default="real")
+    parser.add_argument("--engine", choices=["lua", "luajit"], default="lua")
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="seconds the stub takes per snippet")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8, help="messages in flight at once")
+    parser.add_argument("--workers", type=int, default=bot.WORKER_COUNT)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--guilds", type=int, default=3)
+    parser.add_argument("--cache", action="store_true", help="keep the result cache on")
+    parser.add_argument("--limits", action="store_true", help="keep admission control on, with its default limits")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="baseline json file from an earlier --save")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    result = asyncio.run(run(args))
+    report(result, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
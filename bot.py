@@ -3,8 +3,13 @@ from discord.ext import commands
 import asyncio
 import re
 import os
-import json
 from dotenv import load_dotenv
+from executor import RemotePool, QueueFull, ResultCache, WorkerError, Batch, Profile
+from container import NoContainer
+from service import local_executor, EXECUTOR, WORKER_COUNT
+from storage import ResponseIndex, PreambleStore
+from metrics import Metrics
+from admission import Admission, Busy, DEFAULT_LIMITS
 
 load_dotenv()
 
@@ -13,15 +18,67 @@ intents.message_content = True
 bot = commands.Bot(command_prefix='~', intents=intents, help_command=None)
 MAX_FILE_SIZE = 8 * 1024 * 1024
 
-message_responses = {}
-CONTAINER_NAME = "lua-bot-p"
-IMAGE_NAME = "lua-bot-p-img"
-PREAMBLE_FILE = PREAMBLE_FILE = os.path.join(os.path.dirname(__file__), "preamble.json")
+# set once startup() is done, code that arrives before that waits for it instead of racing it
+ready = asyncio.Event()
 
-TIMEOUT = 10
+# channel id -> "channel" (everyone shares one session) or "user" (everyone gets their own), see ~session
+session_channels = {}
+
+# Lua runtime snippets run on: "lua" (whichever PUC Lua the installed lupa defaults to, 5.4 or newer) or "luajit"
+# (LuaJIT 2.1, much faster at number crunching, but Lua 5.1 syntax and a run that hits the time limit takes its worker
+# down with it). Per server with ~engine (saved next to the preambles), per message with %jit / %lua
+ENGINES = ("lua", "luajit")
+DEFAULT_ENGINE = os.getenv('LUA_ENGINE', 'lua')
+
+# message id -> event handler task working on it / execution it is waiting for
+message_tasks = {}
+running_executions = {}
+PREAMBLE_FILE = PREAMBLE_FILE = os.path.join(os.path.dirname(__file__), "preamble.json")  # only read once, to import it
+PREAMBLES_FILE = os.getenv('PREAMBLES_FILE', os.path.join(os.path.dirname(__file__), "preambles.db"))
+RESPONSES_FILE = os.getenv('RESPONSES_FILE', os.path.join(os.path.dirname(__file__), "responses.db"))
 
-# preamble as a list
-preamble_code = []
+# which bot message answers which user message, survives restarts
+message_responses = ResponseIndex(RESPONSES_FILE)
+
+TIMEOUT = 10
+# edits closer together than this only run once, for the last one
+EDIT_DEBOUNCE = 0.75
+
+# where the time goes, served as prometheus text on METRICS_HOST:METRICS_PORT/metrics (port 0 turns it off) and by ~stats
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+metrics = Metrics()
+metrics_runner = None
+
+# execution service nodes (see service.py) to send code to, comma separated unix:<path> or <host>:<port>,
+# without any the container and workers are run by this process itself
+EXECUTOR_NODES = [node.strip() for node in os.getenv('EXECUTOR_NODES', '').split(',') if node.strip()]
+if EXECUTOR_NODES:
+    container = NoContainer()
+    pool = RemotePool(EXECUTOR_NODES, metrics.observe)
+else:
+    container, pool = local_executor(metrics.observe)
+
+# re-runs and edits that didn't touch the code are answered without going near the container
+result_cache = ResultCache()
+
+# rate limits and a global cap, checked before a snippet costs anything, change them with ~limits
+admission = Admission()
+
+metrics.collect("workers", "gauge", "Warm workers in the pool", lambda: pool.stats()["workers"])
+metrics.collect("workers_busy", "gauge", "Workers running a snippet right now", lambda: pool.stats()["busy"])
+metrics.collect("queued", "gauge", "Snippets waiting for a worker", lambda: pool.stats()["queued"])
+metrics.collect("container_up", "gauge", "1 if the execution container is known to be running",
+                lambda: 1 if container.running else 0)
+metrics.collect("cache_lookups_total", "counter", "Result cache lookups by how they were answered", lambda: {
+    (("result", name),): result_cache.stats()[name] for name in ("hits", "misses", "shared")})
+metrics.collect("inflight", "gauge", "Snippets admitted and not finished yet", lambda: admission.inflight)
+metrics.collect("shed_total", "counter", "Snippets refused by admission control, by which limit", lambda: {
+    (("limit", limit),): n for limit, n in admission.shed.items()})
+metrics.collect("cache_bytes", "gauge", "Size of the cached results", lambda: result_cache.stats()["bytes"])
+
+# every guild has its own preamble, each one a versioned snapshot the workers compile once and cache
+preambles = PreambleStore(PREAMBLES_FILE)
 
 # colors
 COLOR_SYSTEM_ERROR = 0xFF4444
@@ -29,34 +86,86 @@ COLOR_SUCCESS = 0x44FF44
 COLOR_ERROR = 0xFF8C00
 COLOR_INFO = 0x5865F2
 COLOR_EXECUTION_COMPLETE = 0xFFD700
+COLOR_RUNNING = 0x99AAB5
 
+# discord lets a bot edit a message about 5 times per 5 seconds, stay well under that while streaming
+STREAM_EDIT_INTERVAL = 2.0
+STREAM_KEEP_CHARS = 4000
 
-async def load_preamble():
-    """Load preamble from file"""
-    global preamble_code
-    try:
-        if os.path.exists(PREAMBLE_FILE):
-            with open(PREAMBLE_FILE, 'r') as f:
-                preamble_code = json.load(f)
-    except Exception as e:
-        print(f"Error loading preamble: {e}")
-        preamble_code = []
+# most blocks a %batch message runs, and how much of each one fits in its embed field
+MAX_BATCH = 8
+BATCH_FIELD_CHARS = 600
 
+# how much of a source line fits in a ~profile table row
+PROFILE_CODE_CHARS = 40
 
-async def save_preamble():
-    """Save preamble to file"""
+
+async def load_preamble():
+    """Load preambles from disk, without blocking the event loop"""
     try:
-        with open(PREAMBLE_FILE, 'w') as f:
-            json.dump(preamble_code, f, indent=2)
+        await asyncio.to_thread(preambles.load, PREAMBLE_FILE)
     except Exception as e:
-        print(f"Error saving preamble: {e}")
+        print(f"Error loading preamble: {e}")
 
 
 @bot.event
 async def on_ready():
+    # fires again on every reconnect, everything that has to happen once is in startup()
     print(f'{bot.user} has connected!')
-    await load_preamble()
-    await setup_container()
+
+
+async def startup():
+    """Get preambles, container and workers ready while the bot logs in, runs once per process"""
+    start = asyncio.get_running_loop().time()
+    try:
+        await asyncio.gather(load_preamble(), start_metrics(), prepare_executor())
+    finally:
+        # even if something failed, let messages through, they'll retry the container themselves
+        ready.set()
+    print(f"Ready to run code after {asyncio.get_running_loop().time() - start:.1f}s")
+
+
+async def prepare_executor():
+    """Reuse the container if it's already up, otherwise (re)create it, then start the workers"""
+    container.watch()
+    if await container.ensure_running():
+        await pool.warm()
+
+
+async def start_metrics():
+    """Start the metrics endpoint"""
+    global metrics_runner
+    if metrics_runner is not None or not METRICS_PORT:
+        return
+    try:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        print(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        print(f"Error starting metrics endpoint: {e}")
+
+
+async def supersede(message_id, debounce=0.0):
+    """Make the current task the only one handling message_id
+
+    Waits out the debounce, then cancels the older handler's execution and waits for it to wrap up.
+    Returns False if an even newer handler showed up in the meantime.
+    """
+    task = asyncio.current_task()
+    previous = message_tasks.get(message_id)
+    message_tasks[message_id] = task
+    task.add_done_callback(lambda t: message_tasks.pop(message_id) if message_tasks.get(message_id) is t else None)
+
+    if debounce:
+        await asyncio.sleep(debounce)
+        if message_tasks.get(message_id) is not task:
+            return False
+
+    run = running_executions.get(message_id)
+    if run is not None:
+        run.cancel()
+    if previous is not None and previous is not task and not previous.done():
+        await asyncio.wait({previous})
+    return message_tasks.get(message_id) is task
 
 
 @bot.event
@@ -64,6 +173,8 @@ async def on_message(message):
     if message.author == bot.user:
         return
 
+    await supersede(message.id)
+
     # handle ~~ so no 'no command' errors will show
     if message.content.strip().startswith('~~'):
         await process_message(message)
@@ -78,26 +189,27 @@ async def on_message_edit(before, after):
     if after.author == bot.user:
         return
 
+    # rapid edits only run the last version
+    if not await supersede(after.id, EDIT_DEBOUNCE):
+        return
+
     existing_response = await get_existing_response(before.id, after.channel)
     await process_message(after, existing_response)
 
 
 @bot.event
 async def on_message_delete(message):
+    await supersede(message.id)
     await delete_response(message.id, message.channel)
 
 
 async def get_existing_response(message_id, channel):
     """Get existing response message if it exists"""
-    if message_id not in message_responses:
-        return None
-
-    try:
-        response_id = message_responses[message_id]
-        return await channel.fetch_message(response_id)
-    except (discord.NotFound, KeyError):
-        message_responses.pop(message_id, None)
+    response_id = await message_responses.get(message_id)
+    if response_id is None:
         return None
+    # no need to fetch it, editing or deleting only needs the id
+    return channel.get_partial_message(response_id)
 
 
 async def delete_response(message_id, channel):
@@ -108,43 +220,91 @@ async def delete_response(message_id, channel):
             await existing_response.delete()
         except discord.NotFound:
             pass
-        message_responses.pop(message_id, None)
+        message_responses.pop(message_id)
 
 
 async def process_message(message, existing_response=None):
     """Process message for Lua code execution"""
+    # ~profile in front runs the code with the sampling profiler and answers with where the time went
+    if re.match(r'~profile\b', message.content.strip()):
+        await process_profile(message, existing_response)
+        return
+
     # handle ~~ prefix
     if message.content.strip().startswith('~~'):
         code = message.content.strip()[2:].lstrip()
         if code:
-            response = await execute_lua_code(message, code, existing_response)
+            with metrics.timer("total"):
+                response = await execute_lua_code(message, code, existing_response)
             if response:
-                message_responses[message.id] = response.id
+                message_responses.set(message.id, response.id)
         elif existing_response:
             await delete_response(message.id, message.channel)
         return
 
-    # handle ```code``` blocks (with or without lua)
-    matches = re.findall(r"%```(?:lua\s*)?(.*?)```",
-                         message.content, re.DOTALL | re.IGNORECASE)
+    with metrics.timer("scan"):
+        # handle ```code``` blocks (with or without lua)
+        block = r"%```(?:lua\s*)?(.*?)```"
+        matches = re.findall(block, message.content, re.DOTALL | re.IGNORECASE)
+
+        # handle %`code` blocks (with or without lua)
+        if not matches:
+            block = r"%`(?:lua\s*)?(.*?)`"
+            matches = re.findall(block, message.content, re.DOTALL | re.IGNORECASE)
 
-    # handle %`code` blocks (with or without lua)
-    if not matches:
-        matches = re.findall(r"%`(?:lua\s*)?(.*?)`",
-                             message.content, re.DOTALL | re.IGNORECASE)
+        # %batch or %chain outside the blocks opts in to running all of them, %jit or %lua picks the engine
+        outside = re.sub(block, "", message.content, flags=re.DOTALL | re.IGNORECASE)
+        mode = re.search(r"%(batch|chain)\b", outside)
+        flag = re.search(r"%(jit|lua)\b", outside)
 
     if matches:
-        for lua_code in matches:
-            lua_code = lua_code.strip()
-            if lua_code:
-                response = await execute_lua_code(message, lua_code, existing_response)
-                if response:
-                    message_responses[message.id] = response.id
-                break  # this break is here so if more than one code is in message only first one is run, delete it if you want
+        codes = [lua_code.strip() for lua_code in matches if lua_code.strip()]
+        if codes:
+            if mode and len(codes) > 1:
+                # one worker request for all of them, %chain runs them in one env like a single snippet
+                lua_code = Batch(codes[:MAX_BATCH], chained=mode.group(1) == "chain")
+            else:
+                # only the first block runs unless the message opted in to a batch
+                lua_code = codes[0]
+            engine = {"jit": "luajit", "lua": "lua"}[flag.group(1)] if flag else None
+            with metrics.timer("total"):
+                response = await execute_lua_code(message, lua_code, existing_response, engine)
+            if response:
+                message_responses.set(message.id, response.id)
     elif existing_response:
         await delete_response(message.id, message.channel)
 
 
+async def process_profile(message, existing_response=None):
+    """~profile followed by a block (or just code), only that one snippet runs"""
+    content = message.content.strip()[len('~profile'):].strip()
+    match = (re.search(r"%```(?:lua\s*)?(.*?)```", content, re.DOTALL | re.IGNORECASE)
+             or re.search(r"%`(?:lua\s*)?(.*?)`", content, re.DOTALL | re.IGNORECASE))
+    code = match.group(1).strip() if match else content.removeprefix('~~').strip()
+    if code:
+        with metrics.timer("total"):
+            response = await execute_lua_code(message, Profile(code), existing_response)
+        if response:
+            message_responses.set(message.id, response.id)
+    elif existing_response:
+        await delete_response(message.id, message.channel)
+
+
+def engine_for(message):
+    """Engine the message's server runs snippets on"""
+    return preambles.setting(message.guild.id if message.guild else None, "engine", DEFAULT_ENGINE)
+
+
+def session_key(message):
+    """Session this message's code runs in, None unless session mode is on in its channel"""
+    scope = session_channels.get(message.channel.id)
+    if scope == "channel":
+        return f"c{message.channel.id}:"
+    elif scope == "user":
+        return f"c{message.channel.id}:u{message.author.id}"
+    return None
+
+
 async def create_embed(title, description, color, language="lua"):
     """Create formatted embed for responses"""
     return discord.Embed(
@@ -168,238 +328,348 @@ async def create_output_file(content, filename="output.txt"):
     return discord.File(file_content, filename=filename)
 
 
-async def run_podman_command(cmd, ignore_errors=False):
-    """Run a podman command and return (returncode, stdout, stderr)"""  # some black magic happens here
-    try:
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        return process.returncode, stdout.decode().strip(), stderr.decode().strip()
-    except Exception as e:
-        if not ignore_errors:
-            print(f"Error running command {' '.join(cmd)}: {e}")
-        return 1, "", str(e)
+async def shutdown():
+    """Stop the workers and write out what's pending, the container stays up for the next start"""
+    await pool.stop()
+    await container.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    message_responses.close()
+    preambles.close()
 
 
-async def setup_container():
-    """Set up container for Lua execution"""
+async def run_bot(token):
+    """bot.run, but with startup work going on during login and shutdown inside the same loop"""
+    discord.utils.setup_logging()
+    startup_task = asyncio.create_task(startup())
     try:
-        await ensure_podman_image()
-        await cleanup_container()
-
-        create_cmd = [
-            'podman', 'create', '--name', CONTAINER_NAME,
-            '--memory=512m', '--memory-swap=596m', '--cpus=0.75',  # delete this line if on rpi
-            '--network=none', '--user=botuser', '--read-only',
-            '-i', IMAGE_NAME
-        ]
-
-        returncode, _, stderr = await run_podman_command(create_cmd)
-        if returncode == 0:
-            print(f"Created container: {CONTAINER_NAME}")
-
-            # start the container
-            start_returncode, _, start_stderr = await run_podman_command(['podman', 'start', CONTAINER_NAME])
-            if start_returncode == 0:
-                print(f"Started container: {CONTAINER_NAME}")
-            else:
-                print(f"Failed to start container: {CONTAINER_NAME}")
-                print(f"Start error: {start_stderr}")
-        else:
-            print(f"Failed to create container: {CONTAINER_NAME}")
-            print(f"Error: {stderr}")
-
-    except Exception as e:
-        print(f"Error setting up container: {e}")
-
-
-async def cleanup_container():
-    """Clean up container"""
-    for cmd in [['podman', 'stop', '--timeout=1', CONTAINER_NAME], ['podman', 'rm', CONTAINER_NAME]]:
-        returncode, _, stderr = await run_podman_command(cmd, ignore_errors=True)
-        if returncode != 0 and "no such container" not in stderr.lower():
-            print(f"Cleanup warning for {' '.join(cmd)}: {stderr}")
-
+        async with bot:
+            await bot.start(token)
+    finally:
+        startup_task.cancel()
+        await shutdown()
+
+
+class OutputStream:
+    """Shows print output while code is still running, coalesced into one edit per STREAM_EDIT_INTERVAL"""
+
+    def __init__(self, message, existing_response=None):
+        self.message = message
+        self.response = existing_response
+        # only the end is ever shown, so that's all that is kept
+        self.text = ""
+        self.last_edit = 0.0
+        # flush waiting for its turn, and the edit in flight (if any), close() waits for the latter
+        self.task = None
+        self.edit = None
+        self.closed = False
+
+    def feed(self, chunk):
+        """Take new output from the worker, an edit gets scheduled if there isn't one already"""
+        self.text = (self.text + '\n' + chunk if self.text else chunk)[-STREAM_KEEP_CHARS:]
+        if self.task is None and not self.closed:
+            self.task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        loop = asyncio.get_running_loop()
+        delay = self.last_edit + STREAM_EDIT_INTERVAL - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.edit is not None:
+            # a slow edit is still going, the next one needs the response it creates
+            await asyncio.shield(self.edit)
+        if self.closed:
+            return
+        # anything fed from here on needs another edit
+        self.task = None
+        self.last_edit = loop.time()
+        self.edit = asyncio.create_task(self._edit(tail(self.text)))
+
+    async def _edit(self, text):
+        try:
+            embed = await create_embed("Running...", text, COLOR_RUNNING)
+            self.response = await send_or_edit_response(self.message, embed, self.response)
+        except Exception as e:
+            print(f"Error streaming output: {e}")
+
+    async def close(self):
+        """Stop streaming and return the response message the final result should go into"""
+        self.closed = True
+        task, self.task = self.task, None
+        if task is not None:
+            # hasn't started its edit yet, and won't
+            task.cancel()
+        if self.edit is not None:
+            await self.edit
+        return self.response
+
+
+def tail(text, max_chars=900, max_lines=40):
+    """Last part of text that still fits in an embed"""
+    lines = text.splitlines()[-max_lines:]
+    text = '\n'.join(lines)
+    return text[-max_chars:]
+
+
+async def create_timeout_embed(partial_output=""):
+    """Timeout embed, with whatever the code printed before it got stopped"""
+    embed = await create_embed("Execution Timeout", f"Code execution exceeded {TIMEOUT} second limit", COLOR_SYSTEM_ERROR, "")
+    if partial_output.strip():
+        embed.add_field(name="Output before timeout", value=f"```lua\n{tail(partial_output.strip())}\n```", inline=False)
+    return embed
+
+
+async def execute_lua_code(message, lua_code, existing_response=None, engine=None):
+    """Execute Lua code using Podman container, if admission control lets it in, engine None means the server's"""
+    try:
+        admission.enter(message.author.id, message.channel.id, message.guild.id if message.guild else None, pool.depth)
+    except Busy as e:
+        metrics.executed("shed")
+        if not e.notify:
+            return None
+        embed = await create_embed("Busy", f"{e}, try again in a moment", COLOR_SYSTEM_ERROR, "")
+        return await send_or_edit_response(message, embed, existing_response)
 
-async def ensure_container_running():  # todo: merge this and setup_container
-    """Ensure container is running before executing code"""
     try:
-        # check if it even exists and is running
-        inspect_cmd = ['podman', 'inspect', '--format',
-                       '{{.State.Running}}', CONTAINER_NAME]
-        returncode, stdout, stderr = await run_podman_command(inspect_cmd, ignore_errors=True)
-
-        if returncode != 0:
-            # it doesnt exist
-            await setup_container()
-            return True
-
-        is_running = stdout.strip().lower() == 'true'
-        if not is_running:
-            # not running
-            start_returncode, _, start_stderr = await run_podman_command(['podman', 'start', CONTAINER_NAME])
-            if start_returncode != 0:
-                print(f"Failed to start container: {start_stderr}")
-                # recreate if fails
-                await setup_container()
-            return True
-
-        return True
-    except Exception as e:
-        print(f"Error ensuring container is running: {e}")
-        return False
+        return await run_lua_code(message, lua_code, existing_response, engine or engine_for(message))
+    finally:
+        admission.leave()
 
 
-async def execute_lua_code(message, lua_code, existing_response=None):
-    """Execute Lua code using Podman container"""
+async def run_lua_code(message, lua_code, existing_response=None, engine=DEFAULT_ENGINE):
+    """Run admitted code and answer with the result"""
+    stream = OutputStream(message, existing_response)
     try:
-        # Ensure container is running before executing
-        if not await ensure_container_running():
+        if not ready.is_set():
+            with metrics.timer("startup_wait"):
+                await ready.wait()
+
+        # Ensure container is running before executing, free unless it is known (or suspected) to be down
+        with metrics.timer("container_check"):
+            container_ok = await container.ensure_running()
+        if not container_ok:
+            metrics.executed("container_error")
             embed = discord.Embed(
                 title="Container Error", description="Failed to start execution container", color=COLOR_SYSTEM_ERROR)
             return await send_or_edit_response(message, embed, existing_response)
 
-        # combine preamble and users code
-        full_code = '\n'.join(preamble_code) + '\n' + \
-            lua_code if preamble_code else lua_code
-
-        output = ""
-        error = ""
-        exit_flag = False
-
-        while (output == "" and error == ""):
-            exec_cmd = ['podman', 'exec', '-i',
-                        CONTAINER_NAME, 'python', 'run_lua.py']
-
-            process = await asyncio.create_subprocess_exec(
-                *exec_cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-
-            try:
-                stdout, stderr = await asyncio.wait_for(
-                    process.communicate(input=full_code.encode()),
-                    timeout=TIMEOUT
-                )
-            except asyncio.TimeoutError:
-                try:
-                    process.kill()
-                    await process.wait()
-                except:
-                    pass
-                embed = await create_embed("Execution Timeout", f"Code execution exceeded {TIMEOUT} second limit", COLOR_SYSTEM_ERROR, "")
-                return await send_or_edit_response(message, embed, existing_response)
-
-            output = stdout.decode().strip() if stdout else ""
-            error = stderr.decode().strip() if stderr else ""
-
-            if output == "" and error == "":
-                full_code = '\n'.join(preamble_code) + '\nreturn ' + \
-                    lua_code if preamble_code else 'return ' + lua_code
-                if exit_flag:
-                    break
-                exit_flag = True
-            
-        if error != "" and exit_flag:
-            error = ""
-            output = ""
-
-        # black magic ends here
+        # the worker decides by itself whether this is an expression or a statement, so one round trip is enough
+        guild_id = message.guild.id if message.guild else None
+        preamble = preambles.get(guild_id)
+        session = session_key(message) if isinstance(lua_code, str) else None
+        run = asyncio.ensure_future(result_cache.run(
+            # a session's answer depends on everything that ran in it before
+            None if session else ResultCache.key(lua_code, preamble, engine),
+            lambda: pool.run(lua_code, preamble, TIMEOUT, guild_id, message.author.id, stream.feed, session, engine)))
+        running_executions[message.id] = run
+        try:
+            await asyncio.wait({run})
+        except asyncio.CancelledError:
+            run.cancel()
+            raise
+        finally:
+            if running_executions.get(message.id) is run:
+                del running_executions[message.id]
+
+        if run.cancelled():
+            # a newer edit (or a delete) took over, it will deal with whatever is on screen
+            metrics.executed("cancelled")
+            return await stream.close()
 
-        if error:
-            error_lines = error.count('\n') + 1 if error else 0
-
-            # Adjust error line numbers by subtracting preamble lines
-            if preamble_code:
-                preamble_lines = sum(code.count('\n') + 1 for code in preamble_code)
-                def adjust_line(match):
-                    orig_line = int(match.group(1))
-                    new_line = max(0, orig_line - preamble_lines - 1)
-                    return f":{new_line}:"
-                import re
-                error = re.sub(r":(\d+):", adjust_line, error)
-
-            # i am deeply sorry if someone needs to read this code :u
-            if len(error) > 1024 or error_lines > 64:
-                embed = await create_embed("Lua Error", "Errors too long, see attached file", COLOR_ERROR, "")
-                file = await create_output_file(error, "error.txt")
-                return await send_or_edit_response(message, embed, existing_response, file)
-            else:
-                embed = await create_embed("Lua Error", error, COLOR_ERROR)
-                return await send_or_edit_response(message, embed, existing_response)
-        elif output:
-            output_lines = output.count('\n') + 1 if output else 0
-
-            if len(output) > 1024 or output_lines > 64:
-                embed = await create_embed("Lua Output", "Output too long, see attached file", COLOR_SUCCESS, "")
-                file = await create_output_file(output, "output.txt")
-                return await send_or_edit_response(message, embed, existing_response, file)
-            else:
-                embed = await create_embed("Lua Output", output, COLOR_SUCCESS)
-                return await send_or_edit_response(message, embed, existing_response)
-        else:
-            embed = await create_embed("Execution Complete", "", COLOR_EXECUTION_COMPLETE)
+        try:
+            result = run.result()
+        except QueueFull as e:
+            metrics.executed("queue_full")
+            existing_response = await stream.close()
+            embed = await create_embed("Queue Full", f"Too many snippets waiting ({e}), try again in a moment", COLOR_SYSTEM_ERROR, "")
+            return await send_or_edit_response(message, embed, existing_response)
+        except asyncio.TimeoutError:
+            metrics.executed("timeout")
+            existing_response = await stream.close()
+            embed = await create_timeout_embed(stream.text)
             return await send_or_edit_response(message, embed, existing_response)
+        existing_response = await stream.close()
 
+        with metrics.timer("output"):
+            if isinstance(lua_code, Profile):
+                outcome, embed, file = await create_profile_embed(result, lua_code.code)
+            else:
+                outcome, embed, file = await create_result_embed(result)
+            if result.get("session"):
+                add_footer(embed, session_footer(result))
+            # what the worker says it ran on, which is what was asked for unless it never got to run
+            if (result.get("results") or [result])[0].get("engine") == "luajit":
+                add_footer(embed, "Ran on LuaJIT")
+        metrics.executed(outcome)
+        return await send_or_edit_response(message, embed, existing_response, file)
+
+    except WorkerError as e:
+        # maybe the worker crashed, maybe the whole container went away, find out before the next run
+        container.mark_suspect()
+        metrics.executed("worker_error")
+        existing_response = await stream.close()
+        embed = discord.Embed(
+            title="System Error", description=f"System Error: {str(e)}", color=COLOR_SYSTEM_ERROR)
+        return await send_or_edit_response(message, embed, existing_response)
     except FileNotFoundError:
+        metrics.executed("podman_missing")
+        existing_response = await stream.close()
         embed = discord.Embed(
             title="Podman Error", description="Podman not found. Please install Podman.", color=COLOR_SYSTEM_ERROR)
         return await send_or_edit_response(message, embed, existing_response)
     except Exception as e:
+        metrics.executed("system_error")
+        existing_response = await stream.close()
         embed = discord.Embed(
             title="System Error", description=f"System Error: {str(e)}", color=COLOR_SYSTEM_ERROR)
         return await send_or_edit_response(message, embed, existing_response)
 
 
+async def create_result_embed(result):
+    """Turn a worker result into (outcome, embed, file or None)"""
+    if "results" in result:
+        return await create_batch_embed(result["results"])
+    if result["status"] == "timeout":
+        return "timeout", await create_timeout_embed(result["output"]), None
+    elif result["status"] == "budget":
+        return "budget", await create_embed("Budget Exceeded", result["error"] or "", COLOR_SYSTEM_ERROR, ""), None
+
+    output = result["output"].strip()
+    error = (result["error"] or "").strip()
+
+    # black magic ends here
+
+    if result["status"] == "error":
+        error_lines = error.count('\n') + 1 if error else 0
+        title = "Lua Error"
+        if result.get("error_line"):
+            where = result["error_line"]
+            title += f" (line {where['line']})" if where["chunk"] == "stdin" else f" ({where['chunk']}, line {where['line']})"
+
+        # i am deeply sorry if someone needs to read this code :u
+        if len(error) > 1024 or error_lines > 64:
+            embed = await create_embed(title, "Errors too long, see attached file", COLOR_ERROR, "")
+            return "error", embed, await create_output_file(error, "error.txt")
+        else:
+            return "error", await create_embed(title, error, COLOR_ERROR), None
+    elif output:
+        output_lines = output.count('\n') + 1 if output else 0
+
+        if result.get("truncated"):
+            embed = await create_embed("Lua Output", f"Output too long ({result.get('output_bytes', 0)} bytes, middle cut out), see attached file", COLOR_SUCCESS, "")
+            return "ok", embed, await create_output_file(output, "output.txt")
+        elif len(output) > 1024 or output_lines > 64:
+            embed = await create_embed("Lua Output", "Output too long, see attached file", COLOR_SUCCESS, "")
+            return "ok", embed, await create_output_file(output, "output.txt")
+        else:
+            return "ok", await create_embed("Lua Output", output, COLOR_SUCCESS), None
+    else:
+        return "ok", await create_embed("Execution Complete", "", COLOR_EXECUTION_COMPLETE), None
+
+
+async def create_profile_embed(result, code):
+    """Where a ~profile run spent its time: the hottest lines and functions as small tables"""
+    profile = result.get("profile")
+    if profile is None:
+        # never got as far as running (compile error, crash, watchdog), nothing was sampled
+        return await create_result_embed(result)
+    total = profile["total"]
+    lines = code.splitlines()
+
+    def source(line):
+        text = lines[line - 1].strip().replace('`', "'") if 0 < line <= len(lines) else ""
+        return text if len(text) <= PROFILE_CODE_CHARS else text[:PROFILE_CODE_CHARS - 3] + "..."
+
+    def table(rows, label):
+        header = f"{'share':>6} {'~ms':>7}  {label}"
+        body = [f"{n / total:>6.1%} {seconds * 1000:>7.1f}  {name}" for name, n, seconds in rows]
+        return "```\n" + "\n".join([header] + body) + "\n```"
+
+    color = {"ok": COLOR_SUCCESS, "error": COLOR_ERROR}.get(result["status"], COLOR_SYSTEM_ERROR)
+    embed = discord.Embed(title="Lua Profile", color=color)
+    if not total:
+        embed.description = "Finished before the profiler took a single sample, nothing slow in there"
+    else:
+        embed.add_field(name="Hottest lines", inline=False, value=table(
+            [(f"{line:>4}  {source(line)}", n, seconds) for line, n, seconds in profile["lines"]], "line"))
+        embed.add_field(name="Hottest functions", inline=False, value=table(
+            [("main chunk" if line == 0 else f"function on line {line}", n, seconds)
+             for line, n, seconds in profile["functions"]], "function"))
+
+    if result["status"] == "timeout":
+        embed.add_field(name="Ran out of time", value="The numbers cover the run up to the timeout", inline=False)
+    elif result["status"] != "ok":
+        embed.add_field(name="Ended with an error", value=f"```lua\n{tail(result['error'] or '', 500, 10)}\n```", inline=False)
+
+    footer = f"{total} samples over {result['elapsed']:.2f}s"
+    if profile["samples"] < total:
+        footer += f", {1 - profile['samples'] / total:.0%} spent in the preamble before your code ran"
+    embed.set_footer(text=footer + ". Time in a preamble function counts toward the line that called it")
+    return result["status"], embed, None
+
+
+def add_footer(embed, text):
+    """Footer notes go one after another instead of replacing each other"""
+    if embed.footer.text:
+        text = f"{embed.footer.text} · {text}"
+    embed.set_footer(text=text)
+
+
+def session_footer(result):
+    """What happened to the session the code ran in"""
+    if result["session"] == "new":
+        return "Session started fresh"
+    elif result["session"] == "dropped":
+        return "Session dropped, it went over its memory cap, the next run starts fresh"
+    return f"Session continued, using about {result.get('session_bytes', 0) // 1024}KB"
+
+
+async def create_batch_embed(results):
+    """One field per block, if any of them doesn't fit all of the output goes into an attached file too"""
+    outcome = "ok"
+    embed = discord.Embed(title="Lua Batch", color=COLOR_SUCCESS)
+    sections = []
+    attach = False
+    for i, result in enumerate(results):
+        output = result["output"].strip()
+        error = (result["error"] or "").strip()
+        if outcome == "ok":
+            outcome = result["status"]
+        if error:
+            embed.color = COLOR_ERROR
+
+        text = error or output
+        sections.append(f"-- #{i}\n{output}\n{error}".rstrip())
+        if len(text) > BATCH_FIELD_CHARS or text.count('\n') >= 20 or result.get("truncated"):
+            attach = True
+            text = tail(text, BATCH_FIELD_CHARS, 20)
+        name = f"#{i} " + ("Error" if error else "Output")
+        embed.add_field(name=name, value=f"```lua\n{text}\n```" if text else "(no output)", inline=False)
+
+    file = None
+    if attach:
+        embed.set_footer(text="Some output was cut, see attached file")
+        file = await create_output_file("\n\n".join(sections), "output.txt")
+    return outcome, embed, file
+
+
 async def send_or_edit_response(message, embed, existing_response=None, file=None):
     """Send new response or edit existing one"""
-    if existing_response:
-        # always delete and recreate when there's a file involved because stupid discord doesnt let me edit files
-        if file or (existing_response.attachments):
+    with metrics.timer("send"):
+        if existing_response:
+            # files get swapped in the same edit, an empty list drops whatever file was there before
             try:
-                await existing_response.delete()
+                return await existing_response.edit(embed=embed, attachments=[file] if file else [])
             except discord.NotFound:
+                # someone deleted our response, just answer again
                 pass
-            return await message.reply(embed=embed, file=file)
-        else:
-            await existing_response.edit(embed=embed)
-            return existing_response
-    else:
+
         if file:
             return await message.reply(embed=embed, file=file)
         else:
             return await message.reply(embed=embed)
 
 
-async def ensure_podman_image():
-    """Build Podman image if it doesn't exist"""
-    try:
-        returncode, stdout, _ = await run_podman_command(['podman', 'images', '-q', IMAGE_NAME])
-
-        if returncode == 0 and not stdout:
-            print("Building Podman image...")
-            build_returncode, _, build_stderr = await run_podman_command(
-                ['podman', 'build', '-t', IMAGE_NAME, '.'],
-            )
-
-            if build_returncode == 0:
-                print("Podman image built successfully!")
-            else:
-                print(f"Podman build failed: {build_stderr}")
-        elif returncode == 0:
-            print("Podman image found")
-
-    except FileNotFoundError:
-        print("Podman not found. Please install Podman to use this bot.")
-    except Exception as e:
-        print(f"Error with Podman setup: {e}")
-
-
 @bot.command(name='add')
 @commands.has_permissions(manage_messages=True)
 async def add_preamble(ctx, *, code):
@@ -422,12 +692,11 @@ async def add_preamble(ctx, *, code):
         await ctx.send(embed=embed)
         return
 
-    preamble_code.append(clean_code)
-    await save_preamble()
+    num = await preambles.add(ctx.guild.id if ctx.guild else None, clean_code)
 
     embed = discord.Embed(
         title="Preamble Updated",
-        description=f"Added code snippet #{len(preamble_code)-1}",
+        description=f"Added code snippet #{num}",
         color=COLOR_SUCCESS
     )
     embed.add_field(name="Added Code",
@@ -438,6 +707,7 @@ async def add_preamble(ctx, *, code):
 @bot.command(name='show')
 async def show_preamble(ctx):
     """Show current preamble code"""
+    preamble_code = preambles.snippets(ctx.guild.id if ctx.guild else None)
     if not preamble_code:
         embed = discord.Embed(
             title="Preamble", description="No preamble code set", color=COLOR_EXECUTION_COMPLETE)
@@ -460,6 +730,8 @@ async def show_preamble(ctx):
 @commands.has_permissions(manage_messages=True)
 async def delete_preamble(ctx, num: int):
     """Delete preamble code by number"""
+    guild_id = ctx.guild.id if ctx.guild else None
+    preamble_code = preambles.snippets(guild_id)
     if not preamble_code:
         embed = discord.Embed(
             title="Error", description="No preamble code to delete", color=COLOR_ERROR)
@@ -475,8 +747,7 @@ async def delete_preamble(ctx, num: int):
         await ctx.send(embed=embed)
         return
 
-    deleted_code = preamble_code.pop(num)
-    await save_preamble()
+    deleted_code = await preambles.delete(guild_id, num)
 
     embed = discord.Embed(title="Preamble Updated",
                           description=f"Deleted snippet #{num}", color=COLOR_EXECUTION_COMPLETE)
@@ -485,6 +756,121 @@ async def delete_preamble(ctx, num: int):
     await ctx.send(embed=embed)
 
 
+@bot.command(name='session')
+async def session_command(ctx, action="status"):
+    """Turn session mode on (shared or per user) or off for this channel, or reset a session"""
+    channel_id = ctx.channel.id
+    if action in ("on", "user", "off") and not ctx.channel.permissions_for(ctx.author).manage_messages:
+        raise commands.MissingPermissions(["manage_messages"])
+
+    if action in ("on", "user") and EXECUTOR == 'fork':
+        description = "Sessions aren't available here, every run happens in its own short-lived process"
+    elif action in ("on", "user", "off"):
+        # whatever was kept under the old mode is gone either way
+        await pool.reset_sessions(f"c{channel_id}:")
+        if action == "off":
+            session_channels.pop(channel_id, None)
+            description = "Session mode is off, every run starts from scratch again"
+        else:
+            session_channels[channel_id] = "channel" if action == "on" else "user"
+            who = "everyone in this channel shares one" if action == "on" else "everyone here gets their own"
+            description = f"Session mode is on, {who}: globals stay around between runs"
+    elif action == "reset":
+        key = session_key(ctx.message)
+        if key is None:
+            description = "Session mode is off in this channel"
+        else:
+            await pool.reset_session(key)
+            description = "Session reset, the next run starts fresh"
+    else:
+        scope = session_channels.get(channel_id)
+        description = {None: "Session mode is off in this channel", "channel": "One shared session for this channel",
+                       "user": "One session per user in this channel"}[scope]
+        description += "\n`~session on` / `~session user` / `~session off` / `~session reset`"
+
+    embed = discord.Embed(title="Session", description=description, color=COLOR_INFO)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='engine')
+async def engine_command(ctx, engine=None):
+    """Show or change the engine this server runs snippets on"""
+    if ctx.guild is None:
+        description = f"Snippets here run on {DEFAULT_ENGINE}, use `%jit` or `%lua` next to a block to pick for one message"
+    elif engine is None:
+        description = (f"This server runs snippets on {engine_for(ctx.message)}\n"
+                       "`~engine lua` / `~engine luajit`, or `%jit` / `%lua` next to a block for one message")
+    elif engine not in ENGINES:
+        description = f"Unknown engine, pick one of {', '.join(ENGINES)}"
+    else:
+        if not ctx.channel.permissions_for(ctx.author).manage_messages:
+            raise commands.MissingPermissions(["manage_messages"])
+        await preambles.set_setting(ctx.guild.id, "engine", None if engine == DEFAULT_ENGINE else engine)
+        description = f"Snippets in this server run on {engine} now"
+        if engine == "luajit":
+            description += " (Lua 5.1: no `//`, no bitwise operators and no separate integer type)"
+
+    embed = discord.Embed(title="Engine", description=description, color=COLOR_INFO)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='queue')
+async def show_queue(ctx):
+    """Show worker pool load"""
+    stats = pool.stats()
+    embed = discord.Embed(title="Execution Queue", color=COLOR_INFO)
+    embed.add_field(name="Workers", value=f"{stats['busy']}/{stats['workers']} busy", inline=True)
+    embed.add_field(name="Queued", value=f"{stats['queued']} in {stats['queued_guilds']} server(s)", inline=True)
+    embed.add_field(name="Wait", value=f"avg {stats['avg_wait']:.2f}s, max {stats['max_wait']:.2f}s", inline=True)
+    cache = result_cache.stats()
+    embed.add_field(name="Cache", value=f"{cache['hits']} hits, {cache['misses']} misses, {cache['shared']} shared ({cache['hit_rate']:.0%})", inline=False)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='limits')
+@commands.is_owner()
+async def limits_command(ctx, name=None, value: float = None):
+    """Show admission limits, or change one: ~limits user_rate 0.5"""
+    if name is not None:
+        if value is None:
+            embed = discord.Embed(title="Error", description="Usage: `~limits <name> <value>`", color=COLOR_ERROR)
+            await ctx.send(embed=embed)
+            return
+        try:
+            admission.configure(name, value)
+        except (KeyError, ValueError) as e:
+            embed = discord.Embed(title="Error", description=f"Can't set {name}: {e}. Known limits: {', '.join(DEFAULT_LIMITS)}", color=COLOR_ERROR)
+            await ctx.send(embed=embed)
+            return
+
+    stats = admission.stats()
+    embed = discord.Embed(title="Admission Limits", description="0 means no limit", color=COLOR_INFO)
+    embed.add_field(name="Limits", value="\n".join(f"`{k}` = {v}" for k, v in stats["limits"].items()), inline=True)
+    embed.add_field(name="In flight", value=str(stats["inflight"]), inline=True)
+    embed.add_field(name="Shed", value=", ".join(f"{n} by {limit}" for limit, n in sorted(stats["shed"].items())) or "None", inline=True)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='stats')
+async def show_stats(ctx):
+    """Show where time goes per stage, and how much gets done"""
+    embed = discord.Embed(title="Bot Stats", color=COLOR_INFO)
+    stages = [f"`{stage:<15}` n={h.count} p50 {h.percentile(0.5) * 1000:.1f}ms p95 {h.percentile(0.95) * 1000:.1f}ms p99 {h.percentile(0.99) * 1000:.1f}ms"
+              for stage, h in sorted(metrics.stages.items())]
+    embed.add_field(name="Stages", value="\n".join(stages) or "Nothing measured yet", inline=False)
+
+    outcomes = {dict(labels)["outcome"]: int(value) for (name, labels), value in metrics.counters.items()
+                if name == "executions_total"}
+    embed.add_field(name="Executions", value=", ".join(f"{n} {outcome}" for outcome, n in sorted(outcomes.items())) or "None yet", inline=False)
+    embed.add_field(name="Throughput", value=f"{metrics.rate(60):.2f}/s (last minute)", inline=True)
+
+    stats = pool.stats()
+    embed.add_field(name="Workers", value=f"{stats['busy']}/{stats['workers']} busy, {stats['queued']} queued", inline=True)
+    cache = result_cache.stats()
+    embed.add_field(name="Cache", value=f"{cache['hit_rate']:.0%} hit rate", inline=True)
+    await ctx.send(embed=embed)
+
+
 @bot.command(name='help')
 async def help_command(ctx):
     """Show help information"""  # very pwetty format isnt it :3
@@ -496,13 +882,25 @@ async def help_command(ctx):
 
     embed.add_field(
         name="Usage",
-        value="• **Triple backticks:** ` %```<your_code>``` ` or single backticks\n• **Command:** `~~<your_code>`",
+        value="• **Triple backticks:** ` %```<your_code>``` ` or single backticks\n• **Command:** `~~<your_code>`\n• **Several blocks:** add `%batch` (each on its own) or `%chain` (sharing globals) to run them all\n• **Slow code:** put `~profile` in front to see which lines take the time\n• **Engine:** add `%jit` to run a block on LuaJIT, `%lua` for plain Lua",
+        inline=False
+    )
+
+    embed.add_field(
+        name="Session Commands",
+        value="• `~session on` - Keep globals between runs, shared by the channel\n• `~session user` - Same, but one session per user\n• `~session off` - Back to a fresh start every run\n• `~session reset` - Start your session over",
         inline=False
     )
 
     embed.add_field(
         name="Preamble Commands",
-        value="• `~add <code>` - Add permanent code\n• `~show` - Show current preamble\n• `~del <num>` - Delete preamble by number",
+        value="• `~add <code>` - Add permanent code for this server\n• `~show` - Show this server's preamble\n• `~del <num>` - Delete preamble by number",
+        inline=False
+    )
+
+    embed.add_field(
+        name="Other Commands",
+        value="• `~queue` - Show how busy the execution workers are\n• `~stats` - Show timings per stage and throughput\n• `~engine [lua|luajit]` - Show or change this server's Lua engine\n• `~limits [name value]` - Show or change rate limits (bot owner)",
         inline=False
     )
 
@@ -535,6 +933,14 @@ async def on_command_error(ctx, error):
         )
         await ctx.send(embed=embed)
         return
+    elif isinstance(error, commands.NotOwner):
+        embed = discord.Embed(
+            title="Permission Denied",
+            description="Only the bot owner can use this command.",
+            color=COLOR_ERROR
+        )
+        await ctx.send(embed=embed)
+        return
     # log other errors
     print(f"Command error: {error}")
 
@@ -547,7 +953,6 @@ if __name__ == "__main__":
         exit(1)
 
     try:
-        bot.run(token)
-    finally:
-        # Cleanup on exit
-        asyncio.run(cleanup_container())
+        asyncio.run(run_bot(token))
+    except KeyboardInterrupt:
+        pass
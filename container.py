@@ -0,0 +1,514 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tarfile
+import urllib.parse
+import aiohttp
+from executor import STREAM_LIMIT, start_process
+
+# podman event statuses that mean the container can't run anything anymore
+DOWN_EVENTS = {"died", "stop", "kill", "remove", "cleanup", "pause", "oom"}
+UP_EVENTS = {"start", "restart", "unpause"}
+
+# how long to wait before reconnecting when the event stream goes away
+EVENTS_RETRY = 5
+
+# docker-compatible api version, podman serves it too
+API_VERSION = "v1.41"
+
+# what the image is built from, the only files sent as build context over the api (no databases, .env or venvs),
+# the image (and every container made from it) is labeled with a hash of these,
+# so an image from an older run_lua.py gets rebuilt instead of starting workers that speak an old protocol
+BUILD_FILES = ("Dockerfile", "run_lua.py")
+SOURCE_LABEL = "luabot.source"
+
+
+async def run_podman_command(cmd, ignore_errors=False):
+    """Run a podman command and return (returncode, stdout, stderr)"""  # some black magic happens here
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        return process.returncode, stdout.decode().strip(), stderr.decode().strip()
+    except Exception as e:
+        if not ignore_errors:
+            print(f"Error running command {' '.join(cmd)}: {e}")
+        return 1, "", str(e)
+
+
+def default_socket():
+    """Where the podman api socket usually is for the current user"""
+    if os.getuid() == 0:
+        return "/run/podman/podman.sock"
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR') or f"/run/user/{os.getuid()}"
+    return os.path.join(runtime_dir, "podman", "podman.sock")
+
+
+# both backends below have the same methods, ContainerManager and the worker pool don't care which one they get:
+#   state(name) -> "running" | "stopped" | None if there is no such container
+#   start(name), create(name, image, limits), build(image, path, labels) -> None, or an error message
+#   image_labels(image), container_labels(name) -> dict, or None if there is no such image / container
+#   remove(name) -> stops and deletes it, missing is fine
+#   events(name) -> async iterator of event statuses ("start", "died", ...)
+#   exec(name, cmd) -> process-like object with stdin/stdout streams, returncode, kill() and wait()
+#   close()
+# limits is a dict: memory_mb, memory_swap_mb, cpus, network, user, read_only
+
+
+class PodmanCLI:
+    """Runs the podman command line tool for everything"""
+
+    async def state(self, name):
+        returncode, stdout, _ = await run_podman_command(
+            ['podman', 'inspect', '--format', '{{.State.Running}}', name], ignore_errors=True)
+        if returncode != 0:
+            return None
+        return "running" if stdout.strip().lower() == 'true' else "stopped"
+
+    async def start(self, name):
+        returncode, _, stderr = await run_podman_command(['podman', 'start', name])
+        return None if returncode == 0 else stderr
+
+    async def create(self, name, image, limits):
+        cmd = ['podman', 'create', '--name', name]
+        if limits.get('memory_mb'):
+            cmd.append(f"--memory={limits['memory_mb']}m")
+        if limits.get('memory_swap_mb'):
+            cmd.append(f"--memory-swap={limits['memory_swap_mb']}m")
+        if limits.get('cpus'):
+            cmd.append(f"--cpus={limits['cpus']}")
+        if limits.get('network'):
+            cmd.append(f"--network={limits['network']}")
+        if limits.get('user'):
+            cmd.append(f"--user={limits['user']}")
+        if limits.get('read_only'):
+            cmd.append('--read-only')
+        returncode, _, stderr = await run_podman_command([*cmd, '-i', image])
+        return None if returncode == 0 else stderr
+
+    async def _labels(self, kind, name, field):
+        returncode, stdout, _ = await run_podman_command(
+            ['podman', kind, 'inspect', '--format', f'{{{{json {field}}}}}', name], ignore_errors=True)
+        if returncode != 0:
+            return None
+        try:
+            return json.loads(stdout) or {}
+        except ValueError:
+            return {}
+
+    async def image_labels(self, image):
+        return await self._labels('image', image, '.Labels')
+
+    async def container_labels(self, name):
+        return await self._labels('container', name, '.Config.Labels')
+
+    async def build(self, image, path, labels):
+        cmd = ['podman', 'build', '-t', image]
+        for key, value in labels.items():
+            cmd.append(f"--label={key}={value}")
+        returncode, _, stderr = await run_podman_command([*cmd, path])
+        return None if returncode == 0 else stderr
+
+    async def remove(self, name):
+        for cmd in [['podman', 'stop', '--timeout=1', name], ['podman', 'rm', name]]:
+            returncode, _, stderr = await run_podman_command(cmd, ignore_errors=True)
+            if returncode != 0 and "no such container" not in stderr.lower():
+                print(f"Cleanup warning for {' '.join(cmd)}: {stderr}")
+
+    async def events(self, name):
+        process = await asyncio.create_subprocess_exec(
+            'podman', 'events', '--filter', f'container={name}', '--filter', 'type=container',
+            '--format', '{{.Status}}',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                yield line.decode().strip().lower()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    async def exec(self, name, cmd):
+        return await start_process(['podman', 'exec', '-i', name, *cmd])
+
+    async def close(self):
+        pass
+
+
+class PodmanAPI:
+    """Talks to the Docker-compatible REST API on podman's unix socket, keeping connections open between calls"""
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket()
+        self.session = None
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.UnixConnector(path=self.socket_path, limit=16)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+        return self.session
+
+    def _url(self, path, **params):
+        url = f"http://podman/{API_VERSION}{path}"
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        return url
+
+    async def _call(self, method, path, body=None, **params):
+        """(status, parsed json or text) for one request"""
+        async with self._session().request(method, self._url(path, **params), json=body) as response:
+            text = await response.text()
+            try:
+                return response.status, json.loads(text) if text else None
+            except ValueError:
+                return response.status, text
+
+    @staticmethod
+    def _error(status, body):
+        if isinstance(body, dict):
+            body = body.get("message") or body
+        return f"{status}: {body}"
+
+    async def state(self, name):
+        status, body = await self._call('GET', f"/containers/{name}/json")
+        if status != 200:
+            return None
+        return "running" if body["State"]["Running"] else "stopped"
+
+    async def start(self, name):
+        status, body = await self._call('POST', f"/containers/{name}/start")
+        # 304 means it was running already
+        return None if status in (204, 304) else self._error(status, body)
+
+    async def create(self, name, image, limits):
+        host_config = {"ReadonlyRootfs": bool(limits.get('read_only'))}
+        if limits.get('memory_mb'):
+            host_config["Memory"] = limits['memory_mb'] * 1024 * 1024
+        if limits.get('memory_swap_mb'):
+            host_config["MemorySwap"] = limits['memory_swap_mb'] * 1024 * 1024
+        if limits.get('cpus'):
+            host_config["NanoCpus"] = int(limits['cpus'] * 1e9)
+        if limits.get('network'):
+            host_config["NetworkMode"] = limits['network']
+        # OpenStdin is `-i`, the entrypoint waits on it and keeps the container alive
+        config = {"Image": image, "OpenStdin": True, "HostConfig": host_config}
+        if limits.get('user'):
+            config["User"] = limits['user']
+        status, body = await self._call('POST', "/containers/create", config, name=name)
+        return None if status == 201 else self._error(status, body)
+
+    async def image_labels(self, image):
+        status, body = await self._call('GET', f"/images/{image}/json")
+        if status != 200:
+            return None
+        return (body.get("Config") or {}).get("Labels") or body.get("Labels") or {}
+
+    async def container_labels(self, name):
+        status, body = await self._call('GET', f"/containers/{name}/json")
+        if status != 200:
+            return None
+        return (body.get("Config") or {}).get("Labels") or {}
+
+    async def build(self, image, path, labels):
+        context = await asyncio.to_thread(build_context, path)
+        url = self._url("/build", t=image, labels=json.dumps(labels))
+        async with self._session().post(url, data=context, headers={"Content-Type": "application/x-tar"}) as response:
+            error = None
+            # progress comes as one json object per line, failures show up as an "error" key
+            async for line in response.content:
+                try:
+                    error = json.loads(line).get("error") or error
+                except ValueError:
+                    pass
+            if response.status != 200:
+                return error or f"build failed with status {response.status}"
+            return error
+
+    async def remove(self, name):
+        for method, path, params in [('POST', f"/containers/{name}/stop", {"t": 1}),
+                                     ('DELETE', f"/containers/{name}", {"force": "true"})]:
+            status, body = await self._call(method, path, **params)
+            if status not in (204, 304, 404):
+                print(f"Cleanup warning for {method} {path}: {self._error(status, body)}")
+
+    async def events(self, name):
+        filters = json.dumps({"container": [name], "type": ["container"]})
+        async with self._session().get(self._url("/events", filters=filters)) as response:
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                yield (event.get("status") or event.get("Action") or "").lower()
+
+    async def exec(self, name, cmd):
+        config = {"AttachStdin": True, "AttachStdout": True, "AttachStderr": False, "Tty": False, "Cmd": cmd}
+        status, body = await self._call('POST', f"/containers/{name}/exec", config)
+        if status != 201:
+            # same thing a failing `podman exec` would look like to the worker
+            raise ConnectionResetError(f"exec failed: {self._error(status, body)}")
+        exec_id = body["Id"]
+
+        # the attach stream is a hijacked http connection, which aiohttp can't hand over, so it gets its own socket
+        reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=STREAM_LIMIT)
+        payload = json.dumps({"Detach": False, "Tty": False}).encode()
+        writer.write(
+            f"POST /{API_VERSION}/exec/{exec_id}/start HTTP/1.1\r\n"
+            "Host: podman\r\n"
+            "Content-Type: application/json\r\n"
+            "Connection: Upgrade\r\n"
+            "Upgrade: tcp\r\n"
+            f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = status_line.split()
+        if len(parts) < 2 or parts[1] not in (b"101", b"200"):
+            writer.close()
+            raise ConnectionResetError(f"exec attach failed: {status_line.decode(errors='replace').strip()}")
+        return ExecProcess(self, exec_id, reader, writer)
+
+    async def exit_code(self, exec_id):
+        status, body = await self._call('GET', f"/exec/{exec_id}/json")
+        if status != 200 or body.get("Running") or body.get("ExitCode") is None:
+            return -1
+        return body["ExitCode"]
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+def source_hash(path):
+    """Short hash of the files the image is built from"""
+    digest = hashlib.sha256()
+    for name in BUILD_FILES:
+        with open(os.path.join(path, name), "rb") as f:
+            digest.update(name.encode() + b"\0" + f.read() + b"\0")
+    return digest.hexdigest()[:16]
+
+
+def build_context(path):
+    """Tar up what the Dockerfile needs for the api"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name in BUILD_FILES:
+            tar.add(os.path.join(path, name), arcname=name)
+    return buffer.getvalue()
+
+
+class ExecProcess:
+    """The bits of asyncio.subprocess.Process a worker uses, on top of an exec attach stream"""
+
+    def __init__(self, api, exec_id, reader, writer):
+        self.api = api
+        self.exec_id = exec_id
+        self.stdin = writer
+        self.stdout = asyncio.StreamReader(limit=STREAM_LIMIT)
+        self.returncode = None
+        self.pump_task = asyncio.create_task(self._pump(reader))
+
+    async def _pump(self, reader):
+        """Undo the stream multiplexing: 8 byte header (stream, 0, 0, 0, big endian size), then the payload"""
+        try:
+            while True:
+                header = await reader.readexactly(8)
+                payload = await reader.readexactly(int.from_bytes(header[4:8], 'big'))
+                if header[0] == 1:
+                    self.stdout.feed_data(payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.stdin.close()
+            try:
+                self.returncode = await self.api.exit_code(self.exec_id)
+            except Exception:
+                self.returncode = -1
+            self.stdout.feed_eof()
+
+    def kill(self):
+        # there's no kill for an exec, but closing stdin makes the worker stop what it's running and exit
+        self.stdin.close()
+
+    async def wait(self):
+        await asyncio.shield(self.pump_task)
+        return self.returncode
+
+
+class ContainerManager:
+    """Keeps the execution container up and remembers whether it is
+
+    Liveness is kept in memory and updated from container events and from workers failing,
+    so checking it before a run costs nothing. Repairs run in the background, one at a time.
+    """
+
+    def __init__(self, backend, name, image, limits):
+        self.backend = backend
+        self.name = name
+        self.image = image
+        self.limits = limits
+        self.path = os.path.dirname(os.path.abspath(__file__))
+        self.source = source_hash(self.path)
+        # None until the first check, then True/False
+        self.running = None
+        self.repair_task = None
+        self.events_task = None
+
+    def watch(self):
+        """Start following events for the container, safe to call more than once"""
+        if self.events_task is None or self.events_task.done():
+            self.events_task = asyncio.create_task(self._watch_events())
+
+    async def _watch_events(self):
+        while True:
+            try:
+                async for status in self.backend.events(self.name):
+                    self._on_event(status)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error following container events: {e}")
+            # events we missed while reconnecting could be anything, look again on the next run
+            self.running = None
+            await asyncio.sleep(EVENTS_RETRY)
+
+    def _on_event(self, status):
+        if status in UP_EVENTS:
+            self.running = True
+        elif status in DOWN_EVENTS:
+            self.running = False
+            # don't wait for the next snippet to notice
+            self.repair()
+
+    def mark_suspect(self):
+        """Something went wrong talking to the container, check it again before the next run"""
+        if self.running:
+            self.running = None
+
+    def repair(self, recreate=False):
+        """Start bringing the container up in the background, joins a repair that is already going"""
+        if self.repair_task is None or self.repair_task.done():
+            self.repair_task = asyncio.create_task(self.setup(recreate))
+        return self.repair_task
+
+    async def ensure_running(self):
+        """True once the container is up, only does any work if it isn't known to be"""
+        if self.running:
+            return True
+        return await asyncio.shield(self.repair())
+
+    async def setup(self, recreate=False):
+        """Make sure the container exists and runs, reusing the existing one unless recreate is set"""
+        try:
+            if not recreate:
+                state = await self.backend.state(self.name)
+                if state is not None:
+                    labels = await self.backend.container_labels(self.name)
+                    if labels is not None and labels.get(SOURCE_LABEL) != self.source:
+                        # made from an image of an older run_lua.py, its workers wouldn't understand us
+                        print("Container is out of date, recreating it")
+                        state = None
+                if state == "running":
+                    self.running = True
+                    return True
+                if state == "stopped":
+                    # exists but stopped, starting it is cheaper than building a new one
+                    error = await self.backend.start(self.name)
+                    if error is None:
+                        self.running = True
+                        return True
+                    print(f"Failed to start container: {error}")
+
+            await self.ensure_image()
+            await self.remove()
+
+            error = await self.backend.create(self.name, self.image, self.limits)
+            if error is not None:
+                print(f"Failed to create container: {self.name}")
+                print(f"Error: {error}")
+                self.running = False
+                return False
+            print(f"Created container: {self.name}")
+
+            error = await self.backend.start(self.name)
+            if error is not None:
+                print(f"Failed to start container: {self.name}")
+                print(f"Start error: {error}")
+                self.running = False
+                return False
+            print(f"Started container: {self.name}")
+            self.running = True
+            return True
+
+        except Exception as e:
+            print(f"Error setting up container: {e}")
+            self.running = False
+            return False
+
+    async def ensure_image(self):
+        """Build the image if it doesn't exist or was built from other sources than the ones here"""
+        try:
+            labels = await self.backend.image_labels(self.image)
+            if labels is None or labels.get(SOURCE_LABEL) != self.source:
+                print("Building Podman image..." if labels is None else "Podman image is out of date, rebuilding it...")
+                error = await self.backend.build(self.image, self.path, {SOURCE_LABEL: self.source})
+                if error is None:
+                    print("Podman image built successfully!")
+                else:
+                    print(f"Podman build failed: {error}")
+            else:
+                print("Podman image found")
+
+        except FileNotFoundError:
+            print("Podman not found. Please install Podman to use this bot.")
+        except Exception as e:
+            print(f"Error with Podman setup: {e}")
+
+    async def remove(self):
+        """Stop and delete the container"""
+        await self.backend.remove(self.name)
+        self.running = False
+
+    async def exec(self, cmd):
+        """Start cmd inside the container, for the worker pool"""
+        return await self.backend.exec(self.name, cmd)
+
+    async def close(self):
+        """Stop watching events and let go of the backend"""
+        tasks = [t for t in (self.events_task, self.repair_task) if t is not None and not t.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.backend.close()
+
+
+class NoContainer:
+    """Stands in for ContainerManager when workers run right on this host, like the forkserver backend"""
+
+    running = True
+
+    def watch(self):
+        pass
+
+    async def ensure_running(self):
+        return True
+
+    def mark_suspect(self):
+        pass
+
+    async def exec(self, cmd):
+        return await start_process(cmd)
+
+    async def close(self):
+        pass
@@ -0,0 +1,761 @@
+import asyncio
+import collections
+import hashlib
+import json
+import itertools
+import re
+import struct
+import time
+import zlib
+
+# worker stdout buffer, frames are read with readexactly so this only bounds how far ahead it reads
+STREAM_LIMIT = 1024 * 1024
+
+# answers from the worker: <header size><body size> (big endian uint32s), json header, raw body, see run_lua.serve
+FRAME = struct.Struct(">II")
+# a batch of outputs is under 10MB, anything near this means the stream is out of step
+MAX_FRAME = 64 * 1024 * 1024
+
+# the worker stops runaway code itself after `timeout`, this is how long past that we wait before killing it
+KILL_GRACE = 5
+
+# sessions the pool remembers the worker of, the workers themselves keep far fewer alive
+MAX_AFFINITY = 10000
+
+# execution service nodes: a node that couldn't be reached is skipped for this long, stats are refreshed this often
+NODE_RETRY_AFTER = 5
+NODE_STATS_INTERVAL = 5
+# longest a run should ever sit in a node's queue, past that plus its timeout the node counts as gone
+NODE_QUEUE_GRACE = 120
+
+# anything that can give a different answer on the next run, kept broad on purpose (aliasing `os` counts too)
+NONDETERMINISTIC = re.compile(r"\bos\b|random")
+
+
+async def start_process(cmd):
+    """Start a worker as a local process with stdin/stdout piped, the default way to spawn one"""
+    return await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        limit=STREAM_LIMIT
+    )
+
+
+class WorkerError(Exception):
+    """Worker process died or answered with garbage"""
+
+
+class Preamble:
+    """Snapshot of the preamble snippets, every change gets a new version"""
+
+    def __init__(self, version, snippets):
+        self.version = version
+        self.snippets = tuple(snippets)
+        self.deterministic = not any(NONDETERMINISTIC.search(snippet) for snippet in self.snippets)
+
+
+class Batch:
+    """Several snippets sent to a worker as one request, each run isolated or (chained) in one shared env"""
+
+    def __init__(self, codes, chained=False):
+        self.codes = tuple(codes)
+        self.chained = chained
+
+
+def pack_outputs(response):
+    """Take the output out of every result in a response, it goes in the frame body instead of the json"""
+    body = []
+    for result in response.get("results", [response]):
+        if "output" in result:
+            data = result.pop("output").encode("utf-8", "replace")
+            result["output_size"] = len(data)
+            body.append(data)
+    return b"".join(body)
+
+
+def unpack_outputs(response, body):
+    """Put every result's output back from the frame body, decoded once"""
+    offset = 0
+    for result in response.get("results", [response]):
+        if "output_size" in result:
+            size = result.pop("output_size")
+            result["output"] = str(body[offset:offset + size], "utf-8", "replace")
+            offset += size
+
+
+class Profile:
+    """A snippet run with the sampling profiler on, the result then has its hottest lines and functions"""
+
+    def __init__(self, code):
+        self.code = code
+
+
+class LuaWorker:
+    """Long-lived `run_lua.py --server` process, requests are multiplexed by id
+
+    spawn is an async function returning something shaped like asyncio.subprocess.Process.
+    """
+
+    def __init__(self, spawn):
+        self.spawn = spawn
+        self.process = None
+        self.pending = {}
+        # request id -> callback for print output streamed before the result
+        self.listeners = {}
+        self.ids = itertools.count(1)
+        self.reader_task = None
+        self.start_lock = asyncio.Lock()
+        # preamble versions this worker process has already been sent
+        self.preambles = set()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        """Start the worker process if it isn't running already"""
+        async with self.start_lock:
+            if self.alive:
+                return
+            self.process = await self.spawn()
+            self.preambles = set()
+            self.reader_task = asyncio.create_task(self._read_loop(self.process))
+
+    async def _read_loop(self, process):
+        """Hand every response frame to whoever is waiting for its id"""
+        try:
+            while True:
+                try:
+                    header_size, body_size = FRAME.unpack(await process.stdout.readexactly(FRAME.size))
+                    if header_size + body_size > MAX_FRAME:
+                        raise ValueError(f"{header_size + body_size} byte frame")
+                    response = json.loads(await process.stdout.readexactly(header_size))
+                    body = memoryview(await process.stdout.readexactly(body_size))
+                except asyncio.IncompleteReadError:
+                    break
+                except ValueError as e:
+                    # can't find the next frame after this, the worker has to go
+                    print(f"Worker sent garbage: {e}")
+                    process.kill()
+                    break
+
+                request_id = response.pop("id", None)
+                if "chunk" in response:
+                    listener = self.listeners.get(request_id)
+                    if listener:
+                        listener(str(body, "utf-8", "replace"))
+                    continue
+                unpack_outputs(response, body)
+                future = self.pending.pop(request_id, None)
+                if future and not future.done():
+                    future.set_result(response)
+        except Exception as e:
+            print(f"Worker reader error: {e}")
+        finally:
+            # worker is gone, nobody is going to answer the rest
+            if self.process is process:
+                self._fail_pending(WorkerError("Worker process exited"))
+
+    def _fail_pending(self, error):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def _send(self, message):
+        self.process.stdin.write(json.dumps(message).encode() + b"\n")
+
+    def _send_preamble(self, preamble):
+        self._send({"op": "preamble", "version": preamble.version, "snippets": preamble.snippets})
+        self.preambles.add(preamble.version)
+
+    async def _request(self, lua_code, preamble, timeout, on_output, session, route=None, engine=None):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        if on_output:
+            self.listeners[request_id] = on_output
+
+        try:
+            if preamble and preamble.version not in self.preambles:
+                self._send_preamble(preamble)
+            if isinstance(lua_code, Batch):
+                code = {"batch": lua_code.codes, "chained": lua_code.chained}
+            elif isinstance(lua_code, Profile):
+                code = {"code": lua_code.code, "profile": True}
+            else:
+                code = {"code": lua_code}
+            if session:
+                code["session"] = session
+            if engine:
+                code["engine"] = engine
+            if route:
+                # only the execution service looks at these, for fairness between guilds and users
+                code.update(route)
+            self._send({"id": request_id, **code, "preamble": preamble.version if preamble else None,
+                        "timeout": timeout})
+            await self.process.stdin.drain()
+            return await future
+        except asyncio.CancelledError:
+            # nobody wants the answer anymore, stop the worker spending time on it
+            if self.alive:
+                self._send({"op": "cancel", "id": request_id})
+            raise
+        finally:
+            self.pending.pop(request_id, None)
+            self.listeners.pop(request_id, None)
+
+    async def run(self, lua_code, preamble, timeout, on_output=None, session=None, engine=None):
+        """Run code on the worker and return {"status": ..., "output": ..., "error": ..., "error_line": ..., ...}
+
+        lua_code can also be a Batch, the answer is {"results": [one of the above per snippet]} then,
+        or a Profile, which adds "profile" to the answer.
+        on_output gets print output as it is produced, in whole lines.
+        session, if given, runs the code in that session's env, which lives on in this worker.
+        engine picks the Lua runtime ("lua" or "luajit"), the worker's default if None.
+        """
+        if not self.alive:
+            try:
+                await self.start()
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                # podman (or its socket) refused, same as the worker dying right away
+                raise WorkerError(f"Couldn't start worker: {e}")
+
+        async def request():
+            response = await self._request(lua_code, preamble, timeout, on_output, session, engine=engine)
+            if "missing_preamble" in response:
+                # worker dropped it from its cache, send it again
+                self.preambles.discard(preamble.version)
+                response = await self._request(lua_code, preamble, timeout, on_output, session, engine=engine)
+            return response
+
+        try:
+            response = await asyncio.wait_for(request(), timeout=timeout + KILL_GRACE)
+        except asyncio.TimeoutError:
+            # the worker is stuck in user code, throw it away and let the next run start a fresh one
+            await self.stop()
+            raise
+        except (BrokenPipeError, ConnectionResetError) as e:
+            await self.stop()
+            raise WorkerError(f"Worker pipe closed: {e}")
+        if response.pop("worker_exiting", False):
+            # its watchdog answered for code that never called the hook (LuaJIT), the process is on its way out
+            await self.stop()
+        return response
+
+    async def send_op(self, message):
+        """Send a message that gets no answer, like resetting a session, dropped if the worker isn't running"""
+        if not self.alive:
+            return
+        try:
+            self._send(message)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    async def stop(self):
+        """Kill the worker process"""
+        process, self.process = self.process, None
+        self._fail_pending(WorkerError("Worker stopped"))
+        if process is None:
+            return
+        try:
+            process.kill()
+            await process.wait()
+        except ProcessLookupError:
+            pass
+        except Exception as e:
+            print(f"Error stopping worker: {e}")
+
+
+class QueueFull(Exception):
+    """Too many snippets already waiting for this user or guild"""
+
+
+class Job:
+    """One snippet waiting for (or running on) a worker"""
+
+    def __init__(self, lua_code, preamble, timeout, guild_id, user_id, on_output, session=None, engine=None):
+        self.lua_code = lua_code
+        self.session = session
+        self.engine = engine
+        self.preamble = preamble
+        self.timeout = timeout
+        self.on_output = on_output
+        # set once a worker picks it up
+        self.task = None
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = asyncio.get_running_loop().time()
+
+
+class WorkerPool:
+    """Fixed set of warm workers fed from per-guild, per-user round-robin queues"""
+
+    def __init__(self, spawn, size, max_queued_per_user=3, max_queued_per_guild=20, observe=None):
+        self.workers = [LuaWorker(spawn) for _ in range(size)]
+        # observe(stage, seconds) gets the queue wait and run time of every job
+        self.observe = observe
+        # session key -> worker that holds its env, least recently used first
+        self.affinity = collections.OrderedDict()
+        self.busy = {w: 0 for w in self.workers}
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queued_per_guild = max_queued_per_guild
+        # guild -> user -> jobs, both levels keep round-robin order (front is served next)
+        self.queues = {}
+        self.depth = 0
+        self.waits = collections.deque(maxlen=200)
+        self.completed = 0
+
+    async def run(self, lua_code, preamble, timeout, guild_id=None, user_id=None, on_output=None, session=None,
+                  engine=None):
+        """Queue code fairly and wait for a worker to run it, session jobs wait for the worker holding their session"""
+        guild_queue = self.queues.setdefault(guild_id, {})
+        user_queue = guild_queue.setdefault(user_id, collections.deque())
+        guild_depth = sum(len(q) for q in guild_queue.values())
+
+        if len(user_queue) >= self.max_queued_per_user or guild_depth >= self.max_queued_per_guild:
+            self._drop_empty(guild_id, user_id)
+            raise QueueFull(f"{len(user_queue)} queued for you, {guild_depth} for this server")
+
+        job = Job(lua_code, preamble, timeout, guild_id, user_id, on_output, session, engine)
+        user_queue.append(job)
+        self.depth += 1
+        self._dispatch()
+
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            # caller gave up, if the job never left the queue make sure it never runs, otherwise stop it
+            job.future.cancel()
+            if job.task is not None:
+                job.task.cancel()
+            raise
+
+    def _drop_empty(self, guild_id, user_id):
+        guild_queue = self.queues.get(guild_id)
+        if guild_queue is None:
+            return
+        if user_id in guild_queue and not guild_queue[user_id]:
+            del guild_queue[user_id]
+        if not guild_queue:
+            del self.queues[guild_id]
+
+    def _next_job(self, idle):
+        """Pop the next job that can run on one of the idle workers, rotating guilds and users so nobody can hog the pool"""
+        for guild_id in list(self.queues):
+            guild_queue = self.queues[guild_id]
+            for user_id in list(guild_queue):
+                user_queue = guild_queue[user_id]
+                while user_queue and user_queue[0].future.done():
+                    user_queue.popleft()
+                    self.depth -= 1
+
+                # a session job can only go to its own worker, the user waits their turn if that one is busy
+                if user_queue and (user_queue[0].session is None or self._session_worker(user_queue[0].session) in idle):
+                    job = user_queue.popleft()
+                    self.depth -= 1
+                    # served ones go to the back of the line
+                    del guild_queue[user_id]
+                    if user_queue:
+                        guild_queue[user_id] = user_queue
+                    del self.queues[guild_id]
+                    if guild_queue:
+                        self.queues[guild_id] = guild_queue
+                    return job
+
+                if not user_queue:
+                    del guild_queue[user_id]
+            if not guild_queue:
+                del self.queues[guild_id]
+        return None
+
+    def _session_worker(self, session):
+        """Worker holding this session, new sessions go to the worker with the fewest"""
+        worker = self.affinity.get(session)
+        if worker is None:
+            counts = collections.Counter(self.affinity.values())
+            worker = self.affinity[session] = min(self.workers, key=lambda w: counts[w])
+            if len(self.affinity) > MAX_AFFINITY:
+                self.affinity.popitem(last=False)
+        self.affinity.move_to_end(session)
+        return worker
+
+    def _dispatch(self):
+        """Hand queued jobs to idle workers"""
+        while self.depth:
+            idle = [w for w in self.workers if not self.busy[w]]
+            if not idle:
+                return
+            job = self._next_job(idle)
+            if job is None:
+                return
+            worker = self._session_worker(job.session) if job.session else idle[0]
+            self.busy[worker] += 1
+            wait = asyncio.get_running_loop().time() - job.enqueued_at
+            self.waits.append(wait)
+            if self.observe:
+                self.observe("queue_wait", wait)
+            job.task = asyncio.create_task(self._run_job(worker, job))
+
+    async def _run_job(self, worker, job):
+        started = asyncio.get_running_loop().time()
+        try:
+            result = await worker.run(job.lua_code, job.preamble, job.timeout, job.on_output, job.session, job.engine)
+            if self.observe:
+                for ran in result.get("results", [result]):
+                    # time spent in Lua itself, exec minus this is the cost of getting it there and back
+                    self.observe("lua", ran.get("elapsed", 0.0))
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            if self.observe:
+                self.observe("exec", asyncio.get_running_loop().time() - started)
+            self.busy[worker] -= 1
+            self.completed += 1
+            self._dispatch()
+
+    def stats(self):
+        """Queue depth, wait times and worker usage"""
+        waits = list(self.waits)
+        return {
+            "workers": len(self.workers),
+            "busy": sum(1 for w in self.workers if self.busy[w]),
+            "queued": self.depth,
+            "queued_guilds": len(self.queues),
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait": max(waits) if waits else 0.0,
+            "completed": self.completed,
+        }
+
+    async def reset_session(self, session):
+        """Forget a session's env, wherever it lives"""
+        worker = self.affinity.pop(session, None)
+        if worker is not None:
+            await worker.send_op({"op": "reset_session", "session": session})
+
+    async def reset_sessions(self, prefix):
+        """Forget every session whose key starts with prefix"""
+        for session in [key for key in self.affinity if key.startswith(prefix)]:
+            await self.reset_session(session)
+
+    async def warm(self):
+        """Start every worker now instead of on its first job"""
+        results = await asyncio.gather(*(worker.start() for worker in self.workers), return_exceptions=True)
+        for error in results:
+            if isinstance(error, Exception):
+                print(f"Error starting worker: {error}")
+
+    async def stop(self):
+        """Kill every worker"""
+        for worker in self.workers:
+            await worker.stop()
+
+
+def parse_address(address):
+    """"unix:<path>" or "<host>:<port>" -> ("unix", path) or ("tcp", host, port)"""
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return "tcp", host or "127.0.0.1", int(port)
+
+
+class Connection:
+    """A socket dressed up as a worker process, so LuaWorker can talk to an execution service through it"""
+
+    def __init__(self, reader, writer):
+        self.stdout = reader
+        self.stdin = writer
+
+    @property
+    def returncode(self):
+        return 0 if self.stdout.at_eof() or self.stdin.is_closing() else None
+
+    def kill(self):
+        self.stdin.close()
+
+    async def wait(self):
+        try:
+            await self.stdin.wait_closed()
+        except (OSError, ConnectionError):
+            pass
+        return self.returncode
+
+
+async def connect(address):
+    """Open a Connection to an execution service, see service.py"""
+    kind, *where = parse_address(address)
+    if kind == "unix":
+        reader, writer = await asyncio.open_unix_connection(where[0], limit=STREAM_LIMIT)
+    else:
+        reader, writer = await asyncio.open_connection(*where, limit=STREAM_LIMIT)
+    return Connection(reader, writer)
+
+
+class ServiceClient(LuaWorker):
+    """One execution service node, requests are multiplexed over the connection just like over a worker's pipes
+
+    The node queues, times out and kills runs itself, this only gives up on a node that stopped answering
+    without closing the connection (network partition, stuck event loop).
+    """
+
+    def __init__(self, address):
+        super().__init__(lambda: connect(address))
+        self.address = address
+        self.inflight = 0
+        self.down_until = 0
+        # last pool stats the node sent, see RemotePool.stats
+        self.node_stats = {}
+
+    async def run(self, lua_code, preamble, timeout, guild_id=None, user_id=None, on_output=None, session=None,
+                  engine=None):
+        """Same as WorkerPool.run, but on the node"""
+        try:
+            await self.start()
+        except OSError as e:
+            self.down_until = time.monotonic() + NODE_RETRY_AFTER
+            raise WorkerError(f"Couldn't reach executor {self.address}: {e}")
+
+        route = {"guild": guild_id, "user": user_id}
+
+        async def request():
+            response = await self._request(lua_code, preamble, timeout, on_output, session, route, engine)
+            if "missing_preamble" in response:
+                # node dropped it (or never got it on this connection), send it again
+                self.preambles.discard(preamble.version)
+                response = await self._request(lua_code, preamble, timeout, on_output, session, route, engine)
+            return response
+
+        self.inflight += 1
+        try:
+            response = await asyncio.wait_for(request(), timeout=timeout + NODE_QUEUE_GRACE + KILL_GRACE)
+        except asyncio.TimeoutError:
+            # the node would have answered with a timeout long ago, skip it for a while and reconnect after
+            self.down_until = time.monotonic() + NODE_RETRY_AFTER
+            await self.stop()
+            raise WorkerError(f"Executor {self.address} stopped answering")
+        except (BrokenPipeError, ConnectionResetError) as e:
+            await self.stop()
+            raise WorkerError(f"Lost executor {self.address}: {e}")
+        finally:
+            self.inflight -= 1
+
+        failed = response.get("failed")
+        if failed == "queue_full":
+            raise QueueFull(response["message"])
+        elif failed == "timeout":
+            raise asyncio.TimeoutError()
+        elif failed:
+            raise WorkerError(response["message"])
+        return response
+
+    async def fetch_stats(self):
+        """Ask the node how busy it is"""
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self._send({"id": request_id, "op": "stats"})
+            await self.process.stdin.drain()
+            self.node_stats = (await future)["stats"]
+        finally:
+            self.pending.pop(request_id, None)
+
+
+class RemotePool:
+    """Stands in for WorkerPool when execution runs on separate nodes (service.py), spreads runs over them
+
+    A session always goes to the same node (the first one that's up, counting from its hash), anything else
+    to the node with the fewest runs in flight from here.
+    """
+
+    def __init__(self, addresses, observe=None):
+        self.nodes = [ServiceClient(address) for address in addresses]
+        self.observe = observe
+        self.stats_task = None
+
+    def _pick(self, session):
+        now = time.monotonic()
+        if session:
+            start = zlib.crc32(session.encode()) % len(self.nodes)
+            order = self.nodes[start:] + self.nodes[:start]
+            return next((node for node in order if node.down_until <= now), order[0])
+        up = [node for node in self.nodes if node.down_until <= now] or self.nodes
+        return min(up, key=lambda node: node.inflight)
+
+    @property
+    def depth(self):
+        return sum(node.node_stats.get("queued", 0) for node in self.nodes)
+
+    async def run(self, lua_code, preamble, timeout, guild_id=None, user_id=None, on_output=None, session=None,
+                  engine=None):
+        node = self._pick(session)
+        started = asyncio.get_running_loop().time()
+        try:
+            return await node.run(lua_code, preamble, timeout, guild_id, user_id, on_output, session, engine)
+        finally:
+            if self.observe:
+                self.observe("exec", asyncio.get_running_loop().time() - started)
+
+    async def reset_session(self, session):
+        await self.reset_sessions(session, exact=True)
+
+    async def reset_sessions(self, prefix, exact=False):
+        """Tell every node to forget the matching sessions, whichever one has them"""
+        op = {"op": "reset_session", "session": prefix} if exact else {"op": "reset_sessions", "prefix": prefix}
+        for node in self.nodes:
+            await node.send_op(op)
+
+    async def _refresh_stats(self):
+        while True:
+            for node in self.nodes:
+                if node.alive:
+                    try:
+                        await asyncio.wait_for(node.fetch_stats(), NODE_STATS_INTERVAL)
+                    except Exception as e:
+                        print(f"Error getting stats from executor {node.address}: {e}")
+            await asyncio.sleep(NODE_STATS_INTERVAL)
+
+    def stats(self):
+        """WorkerPool.stats summed over the nodes, as of their last report"""
+        reports = [node.node_stats for node in self.nodes if node.node_stats]
+        total = {key: sum(report.get(key, 0) for report in reports)
+                 for key in ("workers", "busy", "queued", "queued_guilds", "completed")}
+        total["avg_wait"] = sum(report.get("avg_wait", 0.0) for report in reports) / len(reports) if reports else 0.0
+        total["max_wait"] = max((report.get("max_wait", 0.0) for report in reports), default=0.0)
+        total["nodes"] = sum(1 for node in self.nodes if node.alive)
+        return total
+
+    async def warm(self):
+        """Connect to every node now instead of on the first run"""
+        for node in self.nodes:
+            try:
+                await node.start()
+            except OSError as e:
+                node.down_until = time.monotonic() + NODE_RETRY_AFTER
+                print(f"Error connecting to executor {node.address}: {e}")
+        if self.stats_task is None:
+            self.stats_task = asyncio.create_task(self._refresh_stats())
+
+    async def stop(self):
+        if self.stats_task is not None:
+            self.stats_task.cancel()
+            self.stats_task = None
+        for node in self.nodes:
+            await node.stop()
+
+
+class ResultCache:
+    """LRU of results for deterministic snippets, identical in-flight runs share one execution"""
+
+    def __init__(self, max_entries=512, max_bytes=16 * 1024 * 1024, max_entry_bytes=256 * 1024, ttl=600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        # key -> (expires_at, size, result), oldest first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(lua_code, preamble, engine=None):
+        """Cache key for this code, None if it can't be cached"""
+        # batches and profiles are rare enough that they aren't worth the bookkeeping, and timings differ every run
+        if isinstance(lua_code, (Batch, Profile)) or NONDETERMINISTIC.search(lua_code) or (preamble and not preamble.deterministic):
+            return None
+        # blank edges don't change what the code does, trailing spaces can (inside [[long strings]])
+        normalized = lua_code.strip()
+        version = preamble.version if preamble else -1
+        # same code, different runtime: errors, timings and what compiles at all can differ
+        return hashlib.sha256(f"{engine or ''}\0{version}\0{normalized}".encode()).hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+
+    def put(self, key, result):
+        size = sum(len(v) for v in result.values() if isinstance(v, str))
+        if size > self.max_entry_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, result)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    async def run(self, key, execute):
+        """Return the cached result for key, or await execute() once no matter how many ask at the same time"""
+        if key is None:
+            return await execute()
+
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        flight = self.inflight.get(key)
+        if flight is not None:
+            self.shared += 1
+        else:
+            self.misses += 1
+            # [task, how many callers are waiting on it]
+            flight = [asyncio.ensure_future(execute()), 0]
+            self.inflight[key] = flight
+            flight[0].add_done_callback(lambda t: self._finish(key, t))
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # last one waiting for it is gone, and so is the reason to run it
+            if flight[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            flight[1] -= 1
+
+    def _finish(self, key, task):
+        if self.inflight.get(key, [None])[0] is task:
+            del self.inflight[key]
+        # blown budgets depend on load as much as on the code, don't keep them
+        if not task.cancelled() and task.exception() is None and not task.result().get("budget"):
+            self.put(key, task.result())
+
+    def stats(self):
+        """Hit/miss counters and size"""
+        lookups = self.hits + self.misses + self.shared
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hit_rate": (self.hits + self.shared) / lookups if lookups else 0.0,
+        }
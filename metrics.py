@@ -0,0 +1,133 @@
+import bisect
+import collections
+import contextlib
+import time
+from aiohttp import web
+
+# seconds, wide enough for a cache hit at one end and a timed out snippet at the other
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+
+# how many recent samples per stage are kept for the percentiles in ~stats
+RECENT_SAMPLES = 512
+
+
+class Histogram:
+    """Cumulative prometheus-style buckets, plus the last few samples for percentiles"""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        if index < len(self.buckets):
+            self.buckets[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def percentile(self, p):
+        samples = sorted(self.recent)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class Metrics:
+    """Stage timings, counters and gauges, readable as prometheus text or as a summary for ~stats"""
+
+    def __init__(self, prefix="luabot"):
+        self.prefix = prefix
+        self.stages = {}
+        # (name, sorted label items) -> value
+        self.counters = collections.defaultdict(int)
+        # name -> (kind, help, function returning {label dict as tuple: value})
+        self.collectors = {}
+        # finish times of executions, for the "per second" numbers
+        self.finished = collections.deque(maxlen=10000)
+
+    def observe(self, stage, seconds):
+        """Record how long one stage took"""
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """`with metrics.timer("send"):` records the time spent in the block, even if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def executed(self, outcome):
+        """One snippet finished, outcome is "ok", "error", "timeout", ..."""
+        self.count("executions_total", outcome=outcome)
+        self.finished.append(time.monotonic())
+
+    def collect(self, name, kind, help, function):
+        """Value(s) read at scrape time, function returns a number or {(("label", "value"),): number}"""
+        self.collectors[name] = (kind, help, function)
+
+    def rate(self, window=60):
+        """Executions per second over the last `window` seconds"""
+        since = time.monotonic() - window
+        return sum(1 for t in self.finished if t >= since) / window
+
+    def render(self):
+        """Everything in the prometheus text format"""
+        lines = []
+        name = f"{self.prefix}_stage_seconds"
+        lines += [f"# HELP {name} Time spent in each stage of handling a message", f"# TYPE {name} histogram"]
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, hits in zip(BUCKETS, histogram.buckets):
+                cumulative += hits
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        by_name = collections.defaultdict(list)
+        for (counter, labels), value in self.counters.items():
+            by_name[counter].append((labels, value))
+        for counter, values in sorted(by_name.items()):
+            lines.append(f"# TYPE {self.prefix}_{counter} counter")
+            lines += [f"{self.prefix}_{counter}{_labels(labels)} {value}" for labels, value in sorted(values)]
+
+        for collector, (kind, help, function) in sorted(self.collectors.items()):
+            try:
+                values = function()
+            except Exception as e:
+                print(f"Error collecting {collector}: {e}")
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            lines += [f"# HELP {self.prefix}_{collector} {help}", f"# TYPE {self.prefix}_{collector} {kind}"]
+            lines += [f"{self.prefix}_{collector}{_labels(labels)} {value}" for labels, value in sorted(values.items())]
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        """Expose /metrics over http, returns the runner so it can be cleaned up"""
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
@@ -1,116 +1,1102 @@
+import os
 import sys
-from lupa import LuaRuntime
+import re
+import gc
+import json
+import time
+import struct
+import queue
+import select
+import signal
+import resource
+import importlib
+import threading
+import collections
 
+# only for --forkserver --seccomp, rlimits alone still work without it
+try:
+    import seccomp
+except ImportError:
+    seccomp = None
 
-def execute_lua_code(lua_code):
-    """Execute Lua code in a secure, restricted environment."""
-    result = {"output": "", "error": None}
+# engine name -> lupa module it runs on. LuaJIT is much faster at number crunching, but count hooks don't
+# fire inside compiled traces, so there only the watchdog enforces the time budget (and takes the worker down)
+ENGINES = {"lua": "lupa", "luajit": "lupa.luajit21"}
+DEFAULT_ENGINE = "lua"
 
-    try:
-        # Create Lua runtime
-        lua = LuaRuntime(unpack_returned_tuples=True,
-                         register_eval=False, register_builtins=False)
-
-        # set up Lua 'preamble' (like in LaTeX lmao)
-        lua.execute("""
-            -- Clear all dangerous globals
-            io = nil
-            file = nil
-            package = nil
-            require = nil
-            dofile = nil
-            loadfile = nil
-            load = nil
-            loadstring = nil
-            module = nil
-            rawget = nil
-            rawset = nil
-            rawequal = nil
-            rawlen = nil
-            getmetatable = nil
-            setmetatable = nil
-            debug = nil
-            collectgarbage = nil
-            _G = nil
-            
-            -- restrict os
-            os = {
-                time = os.time,
-                date = os.date,
-                clock = os.clock
-            }
-
-            -- restrict coroutine
-            coroutine = {
-                create = coroutine.create,
-                resume = coroutine.resume,
-                running = coroutine.running,
-                wrap = coroutine.wrap,
-                status = coroutine.status,
-                yield = coroutine.yield,
-                close = coroutine.close
-            }
-            
-            -- Somone told me that gsub can be dangerous when it can be used on functions so...
-            local function safe_gsub(s, pattern, repl, n)
-                local t = type(repl)
-                if t ~= "string" and t ~= "table" then
-                    error("gsub: replacement must be string or table, functions not allowed")
+# per run limits, the bot only kills the worker if these somehow don't fire
+TIMEOUT = 10
+INSTRUCTION_BUDGET = 2_000_000_000
+MEMORY_LIMIT = 64 * 1024 * 1024
+WATCHDOG_GRACE = 2
+# how often print output is streamed back while the code is still running
+STREAM_INTERVAL = 0.5
+# output is capped while it is printed: the first HEAD bytes and the last TAIL bytes are kept, the middle is counted
+OUTPUT_HEAD_BYTES = 1024 * 1024
+OUTPUT_TAIL_BYTES = 64 * 1024
+# a streamed chunk only ever needs the newest lines, the bot shows just the end anyway
+STREAM_CHUNK_BYTES = 4 * 1024
+# return values are also sent on their own (next to the output), this many and cut to this long
+MAX_VALUES = 16
+MAX_VALUE_CHARS = 256
+
+# every answer to the bot is <header size><body size> (big endian uint32s), a json header, then the raw body
+FRAME = struct.Struct(">II")
+# ~profile: how many of the hottest lines and functions are reported
+PROFILE_TOP = 10
+
+# --forkserver: a forked run may map this much on top of what the server already has (lupa caps the Lua heap first)
+FORK_MEMORY_HEADROOM = 2 * MEMORY_LIMIT
+# --seccomp: syscalls a forked run has no business making, they fail with EPERM
+DENIED_SYSCALLS = ("open", "openat", "openat2", "creat", "socket", "connect", "bind", "execve", "execveat",
+                   "fork", "vfork", "clone", "clone3", "kill", "tkill", "tgkill", "ptrace", "mount",
+                   "unlink", "unlinkat", "rename", "renameat", "chmod", "chown")
+
+# where an error happened, the message starts with it once the preamble lines are fixed
+ERROR_POSITION = re.compile(r"(stdin|preamble #\d+):(\d+):")
+
+
+# set up Lua 'preamble' (like in LaTeX lmao), this runs once per worker
+SANDBOX_SETUP = """
+    -- grab what the sandbox itself needs before it gets cleared
+    local G = _G
+    local lua_load, lua_setmetatable, lua_rawset = load, setmetatable, rawset
+    local pairs = pairs
+    local tostring, select, concat = tostring, select, table.concat
+    local string_gsub, string_dump = string.gsub, string.dump
+    local collect = collectgarbage
+    local lua_randomseed = math.randomseed
+
+    -- execution budgets, a count hook checks them so runaway code stops inside the interpreter
+    local now, HEAD_CAP, TAIL_CAP, STREAM_CAP, new_seed = ...
+    local sethook, getinfo = debug.sethook, debug.getinfo
+    local lua_pcall, lua_xpcall, co_resume = pcall, xpcall, coroutine.resume
+    -- only there on LuaJIT
+    local lua_jit = jit
+    local HOOK_EVERY = 10000
+    -- while profiling the hook fires this often instead, every time it does is one sample
+    local PROFILE_EVERY = 1000
+    local BUDGET_ERRORS = {
+        time = "time budget exceeded",
+        instructions = "instruction budget exceeded",
+        cancelled = "cancelled"
+    }
+    local budget = {steps = 0, max_steps = 0, deadline = 0, exceeded = nil, every = HOOK_EVERY}
+
+    -- a sample goes to the line of user code that is running, or that called into the preamble which is,
+    -- level 3 is whatever the hook interrupted
+    local function sample(profile)
+        profile.total = profile.total + 1
+        local level = 3
+        while true do
+            local info = getinfo(level, "Sl")
+            if info == nil then
+                return
+            end
+            if info.source == "=stdin" then
+                local lines, functions = profile.lines, profile.functions
+                lines[info.currentline] = (lines[info.currentline] or 0) + 1
+                functions[info.linedefined] = (functions[info.linedefined] or 0) + 1
+                profile.samples = profile.samples + 1
+                return
+            end
+            level = level + 1
+        end
+    end
+
+    local function hook()
+        if not budget.exceeded then
+            if budget.profile then
+                sample(budget.profile)
+            end
+            budget.steps = budget.steps + budget.every
+            local t = now()
+            if budget.steps > budget.max_steps then
+                budget.exceeded = "instructions"
+            elseif t > budget.deadline then
+                budget.exceeded = "time"
+            elseif budget.cancelled and budget.cancelled() then
+                budget.exceeded = "cancelled"
+            elseif budget.flush and t >= budget.next_flush then
+                budget.next_flush = t + budget.flush_every
+                budget.flush()
+            end
+        end
+        if budget.exceeded then
+            -- fire on every instruction from now on so nothing gets to keep running after catching this
+            sethook(hook, "", 1)
+            error(BUDGET_ERRORS[budget.exceeded], 0)
+        end
+    end
+
+    -- flush (optional) gets called every flush_every seconds while the run is going,
+    -- cancelled (optional) says whether the bot doesn't want this run anymore,
+    -- with profile set samples are counted into budget.profile
+    local function start_budget(seconds, max_steps, flush, flush_every, cancelled, profile)
+        budget.steps, budget.max_steps, budget.exceeded = 0, max_steps, nil
+        budget.deadline = now() + seconds
+        budget.flush, budget.flush_every = flush, flush_every
+        budget.cancelled = cancelled
+        budget.next_flush = now() + (flush_every or 0)
+        budget.every = profile and PROFILE_EVERY or HOOK_EVERY
+        budget.profile = profile and {lines = {}, functions = {}, samples = 0, total = 0} or nil
+        if lua_jit then
+            -- compiled code never calls the hook, a profile would come back empty
+            if profile then
+                lua_jit.off()
+                lua_jit.flush()
+            else
+                lua_jit.on()
+            end
+        end
+        sethook(hook, "", budget.every)
+    end
+
+    -- pcall and friends must not swallow a blown budget
+    local function check_budget(...)
+        if budget.exceeded then
+            error(BUDGET_ERRORS[budget.exceeded], 0)
+        end
+        return ...
+    end
+    pcall = function(...) return check_budget(lua_pcall(...)) end
+    xpcall = function(f, handler, ...)
+        -- a blown budget is raised from inside the hook where hooks are off, so the handler would run unchecked
+        local function guarded(...)
+            if budget.exceeded then
+                return ...
+            end
+            return handler(...)
+        end
+        return check_budget(lua_xpcall(f, guarded, ...))
+    end
+
+    -- coroutines don't share the main thread's hook, every new one gets its own
+    local co_create = coroutine.create
+    local function hooked_create(f)
+        local co = co_create(f)
+        sethook(co, hook, "", budget.exceeded and 1 or budget.every)
+        return co
+    end
+
+    local function resume_or_raise(ok, ...)
+        if not ok then
+            error((...), 0)
+        end
+        return ...
+    end
+
+    local function hooked_wrap(f)
+        local co = hooked_create(f)
+        return function(...)
+            return resume_or_raise(co_resume(co, ...))
+        end
+    end
+
+    -- Clear all dangerous globals
+    io = nil
+    file = nil
+    package = nil
+    require = nil
+    dofile = nil
+    loadfile = nil
+    load = nil
+    loadstring = nil
+    module = nil
+    rawget = nil
+    rawset = nil
+    rawequal = nil
+    rawlen = nil
+    getmetatable = nil
+    setmetatable = nil
+    debug = nil
+    collectgarbage = nil
+    _G = nil
+    -- Lua 5.1 / LuaJIT extras, getfenv(0) would hand out the real globals
+    getfenv = nil
+    setfenv = nil
+    newproxy = nil
+    jit = nil
+
+    -- restrict os
+    os = {
+        time = os.time,
+        date = os.date,
+        clock = os.clock
+    }
+
+    -- restrict coroutine
+    coroutine = {
+        create = hooked_create,
+        resume = function(...) return check_budget(co_resume(...)) end,
+        running = coroutine.running,
+        wrap = hooked_wrap,
+        status = coroutine.status,
+        yield = coroutine.yield,
+        close = coroutine.close
+    }
+
+    -- Somone told me that gsub can be dangerous when it can be used on functions so...
+    local function safe_gsub(s, pattern, repl, n)
+        local t = type(repl)
+        if t ~= "string" and t ~= "table" then
+            error("gsub: replacement must be string or table, functions not allowed", 2)
+        end
+        return string_gsub(s, pattern, repl, n)
+    end
+
+    -- Keep only safe string functions
+    string = {
+        byte = string.byte,
+        char = string.char,
+        find = string.find,
+        format = string.format,
+        len = string.len,
+        lower = string.lower,
+        match = string.match,
+        rep = string.rep,
+        reverse = string.reverse,
+        sub = string.sub,
+        upper = string.upper,
+        gmatch = string.gmatch,
+        gsub = safe_gsub
+    }
+
+    -- freeze what is left, every run reads through to these
+    local base, libs = {}, {}
+    for k, v in pairs(G) do
+        if type(v) == "table" then
+            libs[k] = v
+        else
+            base[k] = v
+        end
+    end
+
+    -- library tables are copied into a run the first time it touches them, so a run
+    -- can scribble over math.floor without the next one noticing
+    local env_mt = {
+        __index = function(env, k)
+            local lib = libs[k]
+            if lib == nil then
+                return base[k]
+            end
+            local copy = {}
+            for name, f in pairs(lib) do
+                copy[name] = f
+            end
+            lua_rawset(env, k, copy)
+            return copy
+        end
+    }
+
+    -- REPL style: results are shown the way print would show them, nothing at all for zero values
+    local function format_results(...)
+        local n = select("#", ...)
+        if n == 0 then
+            return nil
+        end
+        local parts = {}
+        for i = 1, n do
+            parts[i] = tostring((select(i, ...)))
+        end
+        return concat(parts, "\\t"), parts
+    end
+
+    -- preambles are compiled once and kept as bytecode, every run loads that into its own env
+    local function compile_preamble(code)
+        local fn, err = lua_load(code, "=preamble", "t", {})
+        if not fn then
+            error(err, 0)
+        end
+        return {string_dump(fn)}
+    end
+
+    -- lines kept in a window of at most cap bytes, oldest dropped first
+    -- the hook can fire (and throw) anywhere in push, so lines[first..last] is kept filled at every step
+    local function new_window(cap)
+        local window = {lines = {}, first = 1, last = 0, bytes = 0, pushing = false}
+        function window.push(line)
+            window.pushing = true
+            if #line >= cap then
+                line = line:sub(1 - cap)
+            end
+            local lines, last = window.lines, window.last + 1
+            lines[last] = line
+            window.bytes = window.bytes + #line + 1
+            window.last = last
+            while window.bytes > cap do
+                local first = window.first
+                window.first = first + 1
+                window.bytes = window.bytes - #lines[first] - 1
+                lines[first] = nil
+            end
+            window.pushing = false
+        end
+        function window.take()
+            -- a flush from the hook in the middle of a push leaves it alone, its lines go out with the next one
+            if window.pushing or window.last < window.first then
+                return nil
+            end
+            local text = concat(window.lines, "\\n", window.first, window.last)
+            window.lines, window.first, window.last, window.bytes = {}, 1, 0, 0
+            return text
+        end
+        return window
+    end
+
+    -- bounded output: head lines until HEAD_CAP, then only the newest TAIL_CAP bytes, everything gets counted
+    local function new_capture()
+        local capture = {total = 0, truncated = false}
+        local head, head_n, head_bytes = {}, 0, 0
+        local tail = new_window(TAIL_CAP)
+        local recent = new_window(STREAM_CAP)
+
+        function capture.add(line)
+            capture.total = capture.total + #line + 1
+            recent.push(line)
+            if not capture.truncated then
+                if head_bytes + #line + 1 <= HEAD_CAP then
+                    head_n = head_n + 1
+                    head[head_n] = line
+                    head_bytes = head_bytes + #line + 1
+                    return
                 end
-                return string.gsub(s, pattern, repl, n)
-            end
-            
-            -- Keep only safe string functions
-            string = {
-                byte = string.byte,
-                char = string.char,
-                find = string.find,
-                format = string.format,
-                len = string.len,
-                lower = string.lower,
-                match = string.match,
-                rep = string.rep,
-                reverse = string.reverse,
-                sub = string.sub,
-                upper = string.upper,
-                gmatch = string.gmatch,
-                gsub = safe_gsub
-            }
-
-            -- Set up output capture
-            local outputs = {}
-            function print(...)
-                local args = {...}
-                local str_args = {}
-                for i, v in ipairs(args) do
-                    str_args[i] = tostring(v)
+                capture.truncated = true
+                if head_n == 0 then
+                    -- one giant line, keep its start, only the rest of it can end up in the tail
+                    head_n, head[1], head_bytes = 1, line:sub(1, HEAD_CAP), HEAD_CAP
+                    line = line:sub(HEAD_CAP + 1)
                 end
-                table.insert(outputs, table.concat(str_args, '\\t'))
             end
+            tail.push(line)
+        end
+
+        function capture.output()
+            local text = concat(head, "\\n", 1, head_n)
+            if capture.truncated then
+                local kept = tail.bytes
+                local omitted = capture.total - head_bytes - kept
+                text = text .. "\\n[... " .. omitted .. " bytes of output omitted ...]\\n" .. (tail.take() or "")
+            end
+            return text
+        end
+
+        capture.take_recent = recent.take
+        return capture
+    end
+
+    -- env is only passed for chained batches, the next snippet then runs in what the last one left behind
+    local function new_run(preamble, code, env)
+        local fresh = env == nil
+        if fresh then
+            env = lua_setmetatable({}, env_mt)
+            -- the RNG belongs to the whole state, a math.randomseed(42) in the last run mustn't carry over
+            lua_randomseed(new_seed())
+        end
+
+        -- Set up output capture
+        local capture = new_capture()
+        local add = capture.add
+        env.print = function(...)
+            local str_args = {}
+            for i = 1, select("#", ...) do
+                str_args[i] = tostring((select(i, ...)))
+            end
+            add(concat(str_args, "\\t"))
+        end
+
+        local setup
+        if preamble and fresh then
+            setup = lua_load(preamble[1], "=preamble", "b", env)
+        end
+
+        -- try it as an expression first, only fall back to a statement if that doesn't compile.
+        -- not a plain return: the user's call would be a tail call and its errors would lose their line,
+        -- and not through a global like select, which the run's env may have replaced
+        local form = "expression"
+        local fn = lua_load("return (function(...) return ... end)(" .. code .. "\\n)", "=stdin", "t", env)
+        if not fn then
+            local err
+            form = "statement"
+            fn, err = lua_load(code, "=stdin", "t", env)
+            if not fn then
+                error(err, 0)
+            end
+        end
 
-            function get_output()
-                return table.concat(outputs, '\\n')
+        -- return values go through the same capture, right after whatever got printed, and are returned as strings too
+        local function run()
+            if setup then
+                setup()
+            end
+            local results, values = format_results(fn())
+            if results then
+                add(results)
             end
-        """)
+            return values
+        end
+
+        return run, capture, form, env
+    end
+
+    return {
+        new_run = new_run,
+        compile_preamble = compile_preamble,
+        start_budget = start_budget,
+        -- plain C function on purpose, a Lua one would trip the hook it's supposed to remove
+        stop_budget = sethook,
+        budget = budget,
+        -- sessions are charged what the heap grows by between two of these, see live_memory
+        collect = function()
+            collect("collect")
+        end,
+        -- bytes in use right now, garbage included
+        heap = function()
+            return collect("count") * 1024
+        end
+    }
+"""
+
+# built once per worker and engine, see get_sandbox, plus the LuaRuntime under each for its memory limit
+_sandboxes = {}
+_runtimes = {}
+
+# compiled preambles by version, about one per active guild, oldest get dropped first
+PREAMBLE_CACHE_SIZE = 32
+_preambles = collections.OrderedDict()
+
+# live envs for session mode by session key, least recently used first
+MAX_SESSIONS = 16
+SESSION_IDLE = 15 * 60
+SESSION_MEMORY_LIMIT = 16 * 1024 * 1024
+# sessions get dropped, oldest first, while together they hold more than this
+SESSIONS_TOTAL_MEMORY = 48 * 1024 * 1024
+_sessions = collections.OrderedDict()
+# engine -> heap in use after the last full collection a session run did, what the next one adds is charged to it
+_live = {}
+
+
+class Preamble:
+    """One preamble version, compiled for each engine that runs it, plus where each of its snippets starts"""
+
+    def __init__(self, snippets):
+        self.code = "\n".join(snippets)
+        # engine -> (bytecode or None, error or None)
+        self.compiled = {}
+        # 1-based line each snippet starts on once they're joined with newlines
+        self.starts = []
+        line = 1
+        for snippet in snippets:
+            self.starts.append(line)
+            line += snippet.count("\n") + 1
+        self.compile(DEFAULT_ENGINE)
+
+    def compile(self, engine):
+        """(bytecode, None) or (None, error) for this engine, compiled on first use"""
+        if engine not in self.compiled:
+            try:
+                self.compiled[engine] = (get_sandbox(engine).compile_preamble(self.code), None)
+            except Exception as e:
+                self.compiled[engine] = (None, self.fix_lines(str(e)))
+        return self.compiled[engine]
+
+    def fix_lines(self, error):
+        """Turn preamble:<line>: into preamble #<snippet>:<line>:"""
+        def adjust_line(match):
+            line = int(match.group(1))
+            snippet = max((i for i, start in enumerate(self.starts) if start <= line), default=0)
+            start = self.starts[snippet] if self.starts else 1
+            return f"preamble #{snippet}:{line - start + 1}:"
+        return re.sub(r"preamble:(\d+):", adjust_line, error)
+
+
+def random_seed():
+    """Fresh seed for a run's math.random, small enough for LuaJIT's randomseed to keep every bit"""
+    return int.from_bytes(os.urandom(6), "big")
+
+
+def get_sandbox(engine=DEFAULT_ENGINE):
+    """Build the sandboxed runtime for an engine on first use, ImportError if its lupa module isn't there"""
+    sandbox = _sandboxes.get(engine)
+    if sandbox is None:
+        lua = importlib.import_module(ENGINES[engine]).LuaRuntime(
+            unpack_returned_tuples=True, max_memory=MEMORY_LIMIT, register_eval=False, register_builtins=False)
+        sandbox = _sandboxes[engine] = lua.execute(
+            SANDBOX_SETUP, time.monotonic, OUTPUT_HEAD_BYTES, OUTPUT_TAIL_BYTES, STREAM_CHUNK_BYTES, random_seed)
+        _runtimes[engine] = lua
+    return sandbox
+
+
+def live_memory(engine):
+    """Bytes the engine's runtime holds after a full collection
+
+    Asks lupa's allocator rather than collectgarbage("count"), which doesn't see big strings on Lua 5.5.
+    """
+    get_sandbox(engine).collect()
+    return _runtimes[engine].get_memory_used()
+
+
+def session_bytes(engine):
+    """What the sessions living in an engine's runtime hold, roughly"""
+    return sum(s.bytes for s in _sessions.values() if s.engine == engine)
+
+
+class Session:
+    """A live env kept between requests, for session mode"""
+
+    def __init__(self, engine):
+        # an env only works in the runtime it was made in
+        self.engine = engine
+        self.env = None
+        # what runs in this session added to the heap, roughly
+        self.bytes = 0
+        self.used = time.monotonic()
+
+
+def drop_session(key):
+    """Forget a session, its env becomes garbage"""
+    session = _sessions.pop(key, None)
+    if session is not None and session.engine in _live:
+        _live[session.engine] -= session.bytes
+
+
+def expire_sessions(keep=None):
+    """Drop sessions idle for too long, then the oldest ones while there are too many or they hold too much"""
+    now = time.monotonic()
+    for key in [k for k, s in _sessions.items() if now - s.used > SESSION_IDLE and k != keep]:
+        drop_session(key)
+
+    def drop_oldest():
+        for key in _sessions:
+            if key != keep:
+                drop_session(key)
+                return True
+        return False
+
+    while len(_sessions) > MAX_SESSIONS and drop_oldest():
+        pass
+    while sum(s.bytes for s in _sessions.values()) > SESSIONS_TOTAL_MEMORY and drop_oldest():
+        pass
+
+
+def execute_session(key, lua_code, preamble=None, timeout=TIMEOUT, on_output=None, cancelled=None,
+                    engine=DEFAULT_ENGINE):
+    """execute_lua_code, but in the session's env, which is created (with the preamble run in it) on first use
+
+    The result says whether the session was "new", "continued" or "dropped" (over its memory cap, next run starts fresh).
+    Switching engines starts the session over.
+    """
+    expire_sessions(keep=key)
+    session = _sessions.get(key)
+    if session is None or session.engine != engine:
+        drop_session(key)
+        session = _sessions[key] = Session(engine)
+    _sessions.move_to_end(key)
+    state = "continued" if session.env is not None else "new"
+
+    try:
+        sandbox = get_sandbox(engine)
+    except ImportError:
+        sandbox = None
+    if sandbox is not None and engine not in _live:
+        _live[engine] = live_memory(engine)
+    result, env = run_in_env(lua_code, preamble, timeout, on_output, cancelled, session.env, engine=engine)
+    if env is not None:
+        session.env = env
+    session.used = time.monotonic()
+    if sandbox is not None:
+        # one full collection per run: plain runs in between only leave garbage behind, so the growth since
+        # the last one is this session's
+        live = live_memory(engine)
+        session.bytes = max(0, int(session.bytes + live - _live[engine]))
+        _live[engine] = live
+
+    if result["budget"] == "memory" or session.bytes > SESSION_MEMORY_LIMIT:
+        drop_session(key)
+        state = "dropped"
+    result["session"] = state
+    result["session_bytes"] = session.bytes
+    return result
+
+
+def load_preamble(version, snippets):
+    """Compile a preamble version and keep it for the runs that ask for it"""
+    _preambles[version] = Preamble(snippets)
+    _preambles.move_to_end(version)
+    while len(_preambles) > PREAMBLE_CACHE_SIZE:
+        _preambles.popitem(last=False)
+
+
+def new_result(error=None, budget=None):
+    """Empty result, every answer to the bot has all of these keys"""
+    result = {"output": "", "error": error, "form": None, "budget": budget, "truncated": False, "output_bytes": 0,
+              "values": [], "error_line": None, "elapsed": 0.0, "memory": 0, "engine": None}
+    result["status"] = status(result)
+    return result
+
+
+def status(result):
+    """One word for how a run ended: "ok", "error", "timeout" or "budget" (any other limit, or cancelled)"""
+    if result["budget"] == "time":
+        return "timeout"
+    elif result["budget"]:
+        return "budget"
+    return "error" if result["error"] else "ok"
+
+
+def error_line(error):
+    """{"chunk": "stdin"|"preamble #<n>", "line": <n>} for where the error happened, if its message says"""
+    match = ERROR_POSITION.match(error or "")
+    if match is None:
+        return None
+    return {"chunk": match.group(1), "line": int(match.group(2))}
+
+
+def lua_string(call):
+    """Call into Lua for a string, output isn't always valid utf-8 so keep the raw bytes then"""
+    try:
+        return call()
+    except UnicodeDecodeError as e:
+        return e.object
+
+
+def execute_lua_code(lua_code, preamble=None, timeout=TIMEOUT, on_output=None, cancelled=None, profile=False,
+                     engine=DEFAULT_ENGINE):
+    """Execute Lua code in a secure, restricted environment.
+
+    on_output, if given, is called with new print output every STREAM_INTERVAL seconds while the code runs.
+    cancelled, if given, is polled along with the budgets and stops the run once it returns True.
+    Output printed before an error or a blown budget is still returned.
+    With profile the result also gets "profile", see read_profile.
+    engine is one of ENGINES.
+    """
+    return run_in_env(lua_code, preamble, timeout, on_output, cancelled, profile=profile, engine=engine)[0]
+
+
+def execute_batch(codes, preamble=None, timeout=TIMEOUT, chained=False, on_output=None, cancelled=None,
+                  engine=DEFAULT_ENGINE):
+    """Run several snippets in one go, returns a result for each
+
+    Each one gets its own env (with the preamble run in it), or with chained they run one after
+    another in the same env, like one long snippet. timeout covers the whole batch.
+    """
+    deadline = time.monotonic() + timeout
+    results = []
+    env = None
+    for lua_code in codes:
+        remaining = deadline - time.monotonic()
+        # once time is up or the bot gave up on the batch, the rest never gets a turn
+        if results and results[-1]["budget"] == "cancelled":
+            result = new_result("cancelled", "cancelled")
+        elif remaining <= 0:
+            result = new_result("time budget exceeded", "time")
+        elif not lua_code.strip():
+            result = new_result("No Lua code provided")
+        else:
+            result, run_env = run_in_env(lua_code, preamble, remaining, on_output, cancelled, env, engine=engine)
+            if chained:
+                env = run_env
+        results.append(result)
+    return results
+
+
+def read_profile(profile, elapsed):
+    """Hottest lines and functions of the user's code, as [line, samples, ~seconds], functions by the line they start on (0 is the main chunk)
+
+    "samples" counts only the user's code, "total" everything, the difference went to the preamble setting up.
+    """
+    def top(counts):
+        hits = sorted(counts.items(), key=lambda item: -item[1])[:PROFILE_TOP]
+        return [[line, n, elapsed * n / profile.total] for line, n in hits]
+
+    if not profile.total:
+        return {"samples": 0, "total": 0, "lines": [], "functions": []}
+    return {"samples": profile.samples, "total": profile.total,
+            "lines": top(profile.lines), "functions": top(profile.functions)}
+
+
+def run_in_env(lua_code, preamble=None, timeout=TIMEOUT, on_output=None, cancelled=None, env=None, profile=False,
+               engine=DEFAULT_ENGINE):
+    """execute_lua_code, but in env if one is passed, returns (result, env it ran in)"""
+    result = new_result()
+    result["engine"] = engine
+
+    try:
+        sandbox = get_sandbox(engine)
+    except ImportError:
+        result["error"] = f"The {engine} engine isn't installed on this worker"
+        result["status"] = status(result)
+        return result, env
+    memory_error = importlib.import_module(ENGINES[engine]).LuaMemoryError
+    # sessions live in the same runtime, every run still gets the whole budget on top of what they hold
+    _runtimes[engine].set_max_memory(MEMORY_LIMIT + session_bytes(engine))
+
+    chunk, error = preamble.compile(engine) if preamble is not None else (None, None)
+    if error:
+        result["error"] = error
+        result["status"] = status(result)
+        result["error_line"] = error_line(error)
+        return result, env
+
+    capture = None
+    try:
+        # fresh _ENV on top of the prebuilt sandbox (unless one is passed in), the preamble runs in it right before the code
+        fn, capture, result["form"], env = sandbox.new_run(chunk, lua_code, env)
+
+        def flush():
+            text = lua_string(capture.take_recent)
+            if text is not None:
+                on_output(text)
 
         # execute code
-        lua_result = lua.execute(lua_code)
-
-        # get captured output
-        output = lua.eval("get_output()")
-        
-        if output and lua_result is not None:
-            result["output"] = output + "\n" + str(lua_result)
-        elif output:
-            result["output"] = output
-        elif lua_result is not None:
-            result["output"] = str(lua_result)
+        start = time.perf_counter()
+        sandbox.start_budget(timeout, INSTRUCTION_BUDGET, flush if on_output else None, STREAM_INTERVAL, cancelled,
+                             profile)
+        try:
+            values = fn()
+        finally:
+            sandbox.stop_budget()
+            result["elapsed"] = time.perf_counter() - start
+            result["budget"] = sandbox.budget.exceeded
+            if profile:
+                result["profile"] = read_profile(sandbox.budget.profile, result["elapsed"])
+
+        if values is not None:
+            for i in range(1, min(len(values), MAX_VALUES) + 1):
+                value = lua_string(lambda: values[i])
+                if isinstance(value, bytes):
+                    value = value.decode("utf-8", "replace")
+                result["values"].append(value[:MAX_VALUE_CHARS])
 
+    except memory_error:
+        result["budget"] = "memory"
+        result["error"] = f"memory budget exceeded ({MEMORY_LIMIT // (1024 * 1024)}MB)"
     except Exception as e:
-        error_msg = str(e).replace('[string "<python>"]', 'stdin')
-        result["error"] = error_msg
+        # user code is loaded as stdin itself, a [string "<python>"] position is the sandbox's and not one of its lines
+        error_msg = str(e)
+        result["error"] = preamble.fix_lines(error_msg) if preamble else error_msg
 
-    return result
+    # get captured output, whatever got printed before an error too
+    if capture is not None:
+        result["output"] = lua_string(capture.output)
+        result["truncated"] = capture.truncated
+        result["output_bytes"] = capture.total
+    result["memory"] = int(sandbox.heap())
+    result["status"] = status(result)
+    result["error_line"] = error_line(result["error"])
+
+    return result, env
+
+
+def watchdog(job, last_words=None):
+    """Last resort: if a run blows way past its deadline the hook isn't firing, so take the whole worker down
+
+    That's expected on LuaJIT, whose compiled loops never call the hook. last_words gets to answer the run first.
+    """
+    while True:
+        time.sleep(0.5)
+        deadline = job.get("deadline")
+        if deadline is not None and time.monotonic() > deadline:
+            child = job.get("child")
+            if child:
+                # forkserver: only the child is stuck, the server itself is fine
+                print("Watchdog: forked run ignored its budget, killing it", file=sys.stderr)
+                job["killed"] = True
+                job["deadline"] = None
+                os.kill(child, signal.SIGKILL)
+                continue
+            print("Watchdog: run ignored its budget, exiting", file=sys.stderr)
+            if last_words:
+                last_words()
+            os._exit(1)
+
+
+class PipeEvent:
+    """threading.Event look-alike that a forked child still sees getting set, for cancels"""
+
+    def __init__(self):
+        self.read, self.write = os.pipe()
+
+    def set(self):
+        os.write(self.write, b"x")
+
+    def is_set(self):
+        return bool(select.select([self.read], [], [], 0)[0])
+
+    def close(self):
+        os.close(self.read)
+        os.close(self.write)
+
+
+def limit_child(timeout, use_seccomp):
+    """Lock down a forked run: cpu time, address space, no new files, optionally a seccomp filter"""
+    cpu = int(timeout) + 1 + WATCHDOG_GRACE
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    try:
+        with open("/proc/self/statm") as f:
+            mapped = int(f.read().split()[0]) * resource.getpagesize()
+        resource.setrlimit(resource.RLIMIT_AS, (mapped + FORK_MEMORY_HEADROOM,) * 2)
+    except OSError:
+        pass
+    # stdout and the cancel pipe are already open, that's all a run needs
+    resource.setrlimit(resource.RLIMIT_NOFILE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+    if use_seccomp:
+        syscalls = seccomp.SyscallFilter(defaction=seccomp.ALLOW)
+        for name in DENIED_SYSCALLS:
+            try:
+                syscalls.add_rule(seccomp.ERRNO(1), name)
+            except (ValueError, RuntimeError):
+                # not a syscall on this architecture
+                pass
+        syscalls.load()
+
+
+def run_forked(request_id, execute, timeout, job, send):
+    """Run execute() in a forked copy of this server, which sends its own answer
+
+    The copy shares the sandbox and compiled preambles with the server page by page until it writes to them,
+    and whatever it does to its Lua state is gone when it exits. Returns None once the child has answered,
+    otherwise a result saying why it didn't.
+    """
+    job["killed"] = False
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            limit_child(timeout, job["seccomp"])
+            result = execute()
+            result["id"] = request_id
+            send(result, pack_outputs(result))
+            code = 0
+        except BaseException as e:
+            print(f"Forked run failed: {e}", file=sys.stderr)
+        finally:
+            os._exit(code)
+
+    job["child"] = pid
+    try:
+        _, status = os.waitpid(pid, 0)
+    finally:
+        job["child"] = None
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+        return None
+    if job["killed"] or (os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGXCPU):
+        return new_result("time budget exceeded", "time")
+    if os.WIFSIGNALED(status):
+        return new_result(f"Run crashed ({signal.Signals(os.WTERMSIG(status)).name})")
+    return new_result(f"Run crashed (exit code {os.WEXITSTATUS(status)})")
+
+
+def read_requests(requests, job, lock):
+    """Reader thread: queue up requests, but act on cancels right away since the main thread may be busy running Lua"""
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            requests.put({"id": None, "invalid": str(e)})
+            continue
+
+        if request.get("op") == "cancel":
+            with lock:
+                if job["id"] == request.get("id"):
+                    job["cancel"].set()
+                else:
+                    job["cancelled"].add(request.get("id"))
+            continue
+        requests.put(request)
+
+    # stdin closed, the bot is gone (or is done with us), stop whatever is running
+    with lock:
+        job["cancel"].set()
+    requests.put(None)
+
+
+def serve(fork=False, use_seccomp=False):
+    """Run as a long-lived worker answering framed requests on stdin/stdout
+
+    With fork every run happens in a forked child under rlimits (and seccomp if asked for and installed),
+    the server itself only builds the sandbox, compiles preambles and waits. Sessions don't outlive a child,
+    so session requests just run fresh there.
+    """
+    # keep the real stdout for frames only, anything else that gets printed goes to stderr
+    out = sys.stdout.buffer
+    sys.stdout = sys.stderr
+
+    if use_seccomp and seccomp is None:
+        print("seccomp module not installed, forked runs only get rlimits", file=sys.stderr)
+        use_seccomp = False
+    if fork:
+        # build it before the first fork so every child gets it for free, and keep the gc off those pages
+        get_sandbox()
+        gc.freeze()
+
+    job = {"deadline": None, "id": None, "cancel": threading.Event(), "cancelled": set(),
+           "fork": fork, "seccomp": use_seccomp, "child": None, "engine": None}
+    lock = threading.Lock()
+    # the watchdog may answer too, frames must not interleave
+    write_lock = threading.Lock()
+    requests = queue.Queue()
+
+    def send(header, body=b""):
+        header = json.dumps(header).encode()
+        with write_lock:
+            out.write(FRAME.pack(len(header), len(body)))
+            out.write(header)
+            out.write(body)
+            out.flush()
+
+    def last_words():
+        """Answer the stuck run with a timeout, so the bot doesn't take the exit for a crash"""
+        request_id = job["id"]
+        if request_id is None or not write_lock.acquire(timeout=1):
+            return
+        result = new_result("time budget exceeded", "time")
+        result.update(id=request_id, engine=job["engine"], worker_exiting=True)
+        header = json.dumps(result).encode()
+        body = pack_outputs(result)
+        out.write(FRAME.pack(len(header), len(body)) + header + body)
+        out.flush()
+
+    threading.Thread(target=watchdog, args=(job, last_words), daemon=True).start()
+    threading.Thread(target=read_requests, args=(requests, job, lock), daemon=True).start()
+
+    # requests come in one per line, answers go out as frames (see FRAME), this shows their headers:
+    #   {"op": "preamble", "version": <int>, "snippets": [<str>, ...]} -> no answer, compiled and cached
+    #   {"op": "cancel", "id": <int>} -> no answer of its own, that request ends with budget "cancelled"
+    #   {"op": "reset_session", "session": <str>} -> no answer, forgets that session's env
+    #   {"id": <int>, "code": <str>, "preamble": <int|null>, "timeout": <seconds>, "engine": "lua"|"luajit"|null}
+    #       -> {"id": <int>, "status": "ok"|"error"|"timeout"|"budget", "output_size": <int>, "error": <str|null>,
+    #           "error_line": {"chunk": "stdin"|"preamble #<n>", "line": <int>}|null, "values": [<str>, ...],
+    #           "form": "expression"|"statement"|null, "budget": "time"|"instructions"|"memory"|"cancelled"|null,
+    #           "truncated": <bool>, "output_bytes": <int>, "elapsed": <seconds>, "memory": <heap bytes>,
+    #           "engine": <the engine it ran on>}
+    #          the body is the output, output_size bytes of it (not always valid utf-8), output_bytes is what got
+    #          printed in total, truncated or not
+    #       -> {"id": <int>, "missing_preamble": <int>} if that version isn't cached (anymore)
+    #       -> the timeout result with "worker_exiting": true if the watchdog had to step in, the worker exits right after
+    #       with "profile": true the result also has "profile": {"samples": <int>, "total": <int>,
+    #           "lines": [[<line>, <samples>, <seconds>], ...], "functions": [[<first line>, <samples>, <seconds>], ...]}
+    #       with "session": <str> it runs in that session's env, and the result also has
+    #       "session": "new"|"continued"|"dropped" and "session_bytes": <int>
+    #   {"id": <int>, "batch": [<str>, ...], "chained": <bool>, "preamble": <int|null>, "timeout": <seconds>,
+    #    "engine": "lua"|"luajit"|null}
+    #       -> {"id": <int>, "results": [<result like above>, ...]}, one per snippet, timeout is for all of them,
+    #          the body is their outputs one after another
+    #       preceded by any number of {"id": <int>, "chunk": true} with print output while it runs in the body,
+    #       chunks are the newest whole lines since the last one (older ones may be skipped)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id = request.get("id")
+        try:
+            if "invalid" in request:
+                result = new_result(f"Unexpected error: {request['invalid']}")
+            elif request.get("op") == "preamble":
+                load_preamble(request["version"], request["snippets"])
+                continue
+            elif request.get("op") == "reset_session":
+                drop_session(request.get("session"))
+                continue
+            else:
+                result = run_request(request, job, lock, send)
+                if result is None:
+                    # a forked child answered already
+                    continue
+        except Exception as e:
+            result = new_result(f"Unexpected error: {e}")
+
+        result["id"] = request_id
+        send(result, pack_outputs(result))
+
+
+def pack_outputs(response):
+    """Take the output out of every result in a response, it goes in the frame body instead of the json"""
+    body = []
+    for result in response.get("results", [response]):
+        if "output" in result:
+            output = result.pop("output")
+            data = output if isinstance(output, bytes) else output.encode("utf-8", "replace")
+            result["output_size"] = len(data)
+            body.append(data)
+    return b"".join(body)
+
+
+def run_request(request, job, lock, send):
+    """Run one code request from the bot, None if a forked child already answered it"""
+    request_id = request.get("id")
+    lua_code = request.get("code", "").strip()
+    batch = request.get("batch")
+    version = request.get("preamble")
+    engine = request.get("engine") or DEFAULT_ENGINE
+
+    with lock:
+        cancelled = request_id in job["cancelled"]
+        # ids only go up, cancels for this one or anything older can be forgotten now
+        if request_id is not None:
+            job["cancelled"] = {i for i in job["cancelled"] if i > request_id}
+        if cancelled:
+            return new_result("cancelled", "cancelled")
+        job["id"], job["cancel"] = request_id, PipeEvent() if job["fork"] else threading.Event()
+
+    try:
+        if version is not None and version not in _preambles:
+            return {"missing_preamble": version}
+        if not lua_code and not batch:
+            return new_result("No Lua code provided")
+        if engine not in ENGINES:
+            return new_result(f"Unknown engine {engine}")
+        preamble = _preambles.get(version)
+        if job["fork"]:
+            # built here in the server rather than in every child
+            try:
+                get_sandbox(engine)
+                if preamble is not None:
+                    preamble.compile(engine)
+            except ImportError:
+                pass
+        elif not request.get("session"):
+            # cheap, and idle sessions shouldn't wait for the next session run to go away
+            expire_sessions()
+
+        timeout = request.get("timeout", TIMEOUT)
+        job["engine"] = engine
+        job["deadline"] = time.monotonic() + timeout + WATCHDOG_GRACE
+
+        def on_output(text):
+            send({"id": request_id, "chunk": True}, text if isinstance(text, bytes) else text.encode("utf-8", "replace"))
+
+        def execute():
+            if batch:
+                return {"results": execute_batch(batch, preamble, timeout, bool(request.get("chained")),
+                                                 on_output, job["cancel"].is_set, engine)}
+            if request.get("session") and not job["fork"]:
+                return execute_session(request["session"], lua_code, preamble, timeout,
+                                       on_output, job["cancel"].is_set, engine)
+            return execute_lua_code(lua_code, preamble, timeout, on_output, job["cancel"].is_set,
+                                    bool(request.get("profile")), engine)
+
+        try:
+            if job["fork"]:
+                result = run_forked(request_id, execute, timeout, job, send)
+                if result is not None:
+                    # the child never answered, but this is still about the run it made
+                    result["engine"] = engine
+                return result
+            return execute()
+        finally:
+            job["deadline"] = None
+    finally:
+        with lock:
+            job["id"] = None
+            if job["fork"]:
+                job["cancel"].close()
+                job["cancel"] = threading.Event()
 
 
 def main():
@@ -126,7 +1112,8 @@ def main():
             # print it in stderr to make it an error
             print(result['error'], file=sys.stderr)
         elif result["output"]:
-            print(result["output"])
+            output = result["output"]
+            print(output.decode("utf-8", "replace") if isinstance(output, bytes) else output)
 
     except KeyboardInterrupt:
         print("Interrupted", file=sys.stderr)
@@ -135,4 +1122,9 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if "--server" in sys.argv[1:]:
+        serve()
+    elif "--forkserver" in sys.argv[1:]:
+        serve(fork=True, use_seccomp="--seccomp" in sys.argv[1:])
+    else:
+        main()
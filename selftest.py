@@ -0,0 +1,272 @@
+"""Checks the Podman API backend against a stub podman socket, no podman needed
+
+The stub speaks just enough of the Docker-compatible API (containers, images, build, events, exec with its
+upgraded attach stream) and runs exec'd commands as local processes, so the real worker answers through it.
+
+    python selftest.py
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.parse
+
+from container import ContainerManager, PodmanAPI, BUILD_FILES, SOURCE_LABEL
+from executor import WorkerPool
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REASONS = {200: "OK", 201: "Created", 204: "No Content", 304: "Not Modified", 404: "Not Found", 500: "Error"}
+
+
+class StubPodman:
+    """In-memory images and containers behind a unix socket, plain HTTP/1.1 parsed by hand
+
+    Counts every call in self.calls so checks can tell a reuse from a rebuild.
+    """
+
+    def __init__(self):
+        # image -> labels, container name -> {"running", "labels"}, exec id -> {"cmd", "exit_code"}
+        self.images = {}
+        self.containers = {}
+        self.execs = {}
+        self.ids = itertools.count(1)
+        self.calls = {}
+        self.subscribers = set()
+        # whether the last build context held exactly the files the Dockerfile needs
+        self.context = None
+
+    def emit(self, name, status):
+        for queue in self.subscribers:
+            queue.put_nowait({"status": status, "id": name})
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    return
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                url = urllib.parse.urlsplit(target)
+                path = url.path.split("/", 2)[2]
+                params = dict(urllib.parse.parse_qsl(url.query))
+                route = f"{method} {path}"
+                self.calls[route] = self.calls.get(route, 0) + 1
+
+                if method == "POST" and path.startswith("exec/") and path.endswith("/start"):
+                    await self.attach(path.split("/")[1], reader, writer)
+                    return
+                if method == "GET" and path == "events":
+                    await self.events(writer)
+                    return
+                status, answer = self.route(method, path, params, body)
+                payload = json.dumps(answer).encode() if answer is not None else b""
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # cancelled too: attach streams and event subscriptions are still open when the checks are done
+            pass
+        finally:
+            writer.close()
+
+    def route(self, method, path, params, body):
+        parts = path.split("/")
+        if parts[0] == "images" and method == "GET":
+            labels = self.images.get(parts[1])
+            return (404, {"message": "no such image"}) if labels is None else (200, {"Config": {"Labels": labels}})
+        if parts[0] == "build":
+            names = tarfile.open(fileobj=io.BytesIO(body)).getnames()
+            self.context = sorted(names) == sorted(BUILD_FILES)
+            self.images[params["t"]] = json.loads(params.get("labels", "{}"))
+            return 200, {"stream": "built"}
+        if path == "containers/create":
+            image = json.loads(body)["Image"]
+            if image not in self.images:
+                return 404, {"message": "no such image"}
+            # like docker, a container starts out with its image's labels
+            self.containers[params["name"]] = {"running": False, "labels": dict(self.images[image])}
+            return 201, {"Id": params["name"]}
+        if parts[0] == "containers":
+            container = self.containers.get(parts[1])
+            if container is None:
+                return 404, {"message": "no such container"}
+            action = parts[2] if len(parts) > 2 else None
+            if method == "GET" and action == "json":
+                return 200, {"State": {"Running": container["running"]}, "Config": {"Labels": container["labels"]}}
+            if action == "start":
+                if container["running"]:
+                    return 304, None
+                container["running"] = True
+                self.emit(parts[1], "start")
+                return 204, None
+            if action == "stop":
+                container["running"] = False
+                return 204, None
+            if method == "DELETE":
+                del self.containers[parts[1]]
+                return 204, None
+            if action == "exec":
+                exec_id = f"exec{next(self.ids)}"
+                self.execs[exec_id] = {"cmd": json.loads(body)["Cmd"], "exit_code": None}
+                return 201, {"Id": exec_id}
+        if parts[0] == "exec" and method == "GET":
+            run = self.execs.get(parts[1])
+            if run is None:
+                return 404, {"message": "no such exec"}
+            return 200, {"Running": run["exit_code"] is None, "ExitCode": run["exit_code"]}
+        return 404, {"message": f"stub doesn't know {method} {path}"}
+
+    async def events(self, writer):
+        """One chunk per event until the client goes away"""
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n")
+        try:
+            while True:
+                line = json.dumps(await queue.get()).encode() + b"\n"
+                writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                await writer.drain()
+        finally:
+            self.subscribers.discard(queue)
+
+    async def attach(self, exec_id, reader, writer):
+        """The hijacked exec stream: raw stdin in, stdout out with the 8 byte multiplexing headers"""
+        run = self.execs[exec_id]
+        # the worker runs right here instead of in a container
+        cmd = [sys.executable if part == "python" else part for part in run["cmd"]]
+        process = await asyncio.create_subprocess_exec(
+            *cmd, cwd=HERE, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+        writer.write(b"HTTP/1.1 101 UPGRADED\r\nContent-Type: application/vnd.docker.raw-stream\r\n"
+                     b"Connection: Upgrade\r\nUpgrade: tcp\r\n\r\n")
+
+        async def pump_stdin():
+            try:
+                while data := await reader.read(65536):
+                    process.stdin.write(data)
+                    await process.stdin.drain()
+            except ConnectionError:
+                pass
+            finally:
+                process.stdin.close()
+
+        stdin_task = asyncio.create_task(pump_stdin())
+        try:
+            while data := await process.stdout.read(65536):
+                writer.write(bytes([1, 0, 0, 0]) + len(data).to_bytes(4, "big") + data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            run["exit_code"] = await process.wait()
+            stdin_task.cancel()
+
+
+async def check_all(socket_path, stub):
+    results = []
+
+    def check(name, ok, detail=""):
+        results.append(ok)
+        print(f"  {'ok  ' if ok else 'FAIL'} {name}{': ' + detail if detail and not ok else ''}")
+
+    builds = lambda: stub.calls.get("POST build", 0)
+    creates = lambda: stub.calls.get("POST containers/create", 0)
+    starts = lambda: stub.calls.get("POST containers/lua-bot-test/start", 0)
+
+    limits = {"memory_mb": 512, "network": "none", "user": "botuser", "read_only": True}
+    command = ["python", "run_lua.py", "--server"]
+    container = ContainerManager(PodmanAPI(socket_path), "lua-bot-test", "lua-bot-test-img", limits)
+    pool = WorkerPool(lambda: container.exec(command), 1)
+    try:
+        check("setup builds, creates and starts", await container.setup() and builds() == 1
+              and stub.containers["lua-bot-test"]["running"])
+        check("build context is only the files the Dockerfile copies", stub.context is True)
+        check("image labeled with the source hash",
+              stub.images["lua-bot-test-img"].get(SOURCE_LABEL) == container.source)
+
+        await container.setup()
+        check("running container is reused", builds() == 1 and creates() == 1 and starts() == 1)
+
+        result = await pool.run("1 + 1", None, 5)
+        check("exec runs the worker", result.get("output") == "2", str(result))
+        chunks = []
+        result = await pool.run("for i = 1, 3 do print(i) end", None, 5, on_output=chunks.append)
+        check("output comes back through the multiplexed stream", result["output"] == "1\n2\n3", str(result))
+
+        # streaming flushes from the hook used to land in the middle of a print and break the run
+        code = ("for i = 1, 3e5 do print(i) end local t = os.clock() while os.clock() - t < 0.6 do end "
+                "for i = 1, 3e5 do print(i) end")
+        errors = []
+        for _ in range(3):
+            result = await pool.run(code, None, 10, on_output=lambda text: None)
+            if result["error"]:
+                errors.append(result["error"])
+        check("streaming survives a flush in the middle of a print", not errors, "; ".join(errors))
+
+        run = asyncio.create_task(pool.run("while true do end", None, 5))
+        await asyncio.sleep(0.3)
+        run.cancel()
+        start = time.monotonic()
+        result = await pool.run("'after cancel'", None, 5)
+        check("cancel stops the run, the next one goes through",
+              result["output"] == "after cancel" and time.monotonic() - start < 3, str(result))
+
+        container.watch()
+        await asyncio.sleep(0.2)
+        started = starts()
+        stub.containers["lua-bot-test"]["running"] = False
+        stub.emit("lua-bot-test", "died")
+        for _ in range(50):
+            await asyncio.sleep(0.05)
+            if stub.containers["lua-bot-test"]["running"]:
+                break
+        check("a died event gets the container repaired", stub.containers["lua-bot-test"]["running"]
+              and starts() > started and container.running)
+
+        await pool.stop()
+        stub.images["lua-bot-test-img"][SOURCE_LABEL] = "old"
+        stub.containers["lua-bot-test"]["labels"][SOURCE_LABEL] = "old"
+        await container.setup()
+        check("an out of date image is rebuilt and the container recreated", builds() == 2
+              and stub.containers["lua-bot-test"]["labels"].get(SOURCE_LABEL) == container.source)
+        result = await pool.run("'fresh'", None, 5)
+        check("workers start again in the new container", result["output"] == "fresh", str(result))
+    finally:
+        await pool.stop()
+        await container.close()
+    return all(results)
+
+
+async def run():
+    stub = StubPodman()
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, "podman.sock")
+        server = await asyncio.start_unix_server(stub.handle, socket_path)
+        try:
+            print("Podman API backend against a stub socket:")
+            return await check_all(socket_path, stub)
+        finally:
+            server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args()
+    ok = asyncio.run(run())
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""Execution service: the worker pool (and its container) on its own, shared by any number of bot processes
+
+    python service.py --listen unix:/tmp/luabot-exec.sock --listen 127.0.0.1:7100
+
+Bots use it with EXECUTOR_NODES=unix:/tmp/luabot-exec.sock,otherhost:7100 instead of running workers themselves.
+There is no authentication, only listen where nothing but the bots can connect.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import sys
+from dotenv import load_dotenv
+from executor import (WorkerPool, QueueFull, WorkerError, Preamble, Batch, Profile, FRAME, pack_outputs, parse_address,
+                      STREAM_LIMIT)
+from container import ContainerManager, PodmanCLI, PodmanAPI, NoContainer
+
+load_dotenv()
+
+CONTAINER_NAME = "lua-bot-p"
+IMAGE_NAME = "lua-bot-p-img"
+TIMEOUT = 10
+
+# how many warm workers run side by side, each one gets its own share of cpu
+WORKER_COUNT = int(os.getenv('LUA_WORKERS', '2'))
+WORKER_CPUS = 0.75
+MAX_QUEUED_PER_USER = 3
+MAX_QUEUED_PER_GUILD = 20
+
+# "podman" runs workers in a container, "fork" runs forkservers on this host that fork a locked down child
+# per snippet (rlimits, plus seccomp with FORK_SECCOMP=1 if the seccomp module is installed), for small hosts
+EXECUTOR = os.getenv('LUA_EXECUTOR', 'podman')
+
+# "cli" runs the podman command, "api" talks to the podman socket directly (PODMAN_SOCKET, default is the usual place)
+PODMAN_BACKEND = os.getenv('PODMAN_BACKEND', 'cli')
+
+# runs one connection may have going at once, more wait for a slot, and past MAX_WAITING_PER_CONNECTION
+# of those they're answered with queue_full right away. the connection is always read, so cancels get through
+MAX_INFLIGHT_PER_CONNECTION = 64
+MAX_WAITING_PER_CONNECTION = 256
+# preamble versions remembered per connection, the bot sends one again if it was dropped
+PREAMBLES_PER_CONNECTION = 256
+
+
+def local_executor(observe=None):
+    """Container (or a stand-in for it) and the worker pool inside it, set up from the environment"""
+    if EXECUTOR == 'fork':
+        container = NoContainer()
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_lua.py'), '--forkserver']
+        if os.getenv('FORK_SECCOMP') == '1':
+            command.append('--seccomp')
+    else:
+        podman = PodmanAPI(os.getenv('PODMAN_SOCKET')) if PODMAN_BACKEND == 'api' else PodmanCLI()
+        # knows whether the container is up without asking podman every time
+        container = ContainerManager(podman, CONTAINER_NAME, IMAGE_NAME, {
+            'memory_mb': 512, 'memory_swap_mb': 596, 'cpus': WORKER_COUNT * WORKER_CPUS,  # delete this line if on rpi
+            'network': 'none', 'user': 'botuser', 'read_only': True,
+        })
+        command = ['python', 'run_lua.py', '--server']
+
+    # warm run_lua.py processes inside the container (or forkservers), so a snippet costs a pipe round trip instead of a new podman exec
+    pool = WorkerPool(lambda: container.exec(command), WORKER_COUNT, MAX_QUEUED_PER_USER, MAX_QUEUED_PER_GUILD, observe)
+    return container, pool
+
+
+class ExecutorService:
+    """Answers bots over a socket, speaking the worker protocol (see run_lua.serve) with a few additions
+
+    Requests also carry "guild" and "user" for the pool's fairness, "engine" is passed on to the workers. Runs that never got to a worker are
+    answered with {"id": <int>, "failed": "queue_full"|"timeout"|"worker_error", "message": <str>}, and
+    {"id": <int>, "op": "stats"} gets {"id": <int>, "stats": <WorkerPool.stats()>}.
+    Preamble versions are per connection, every bot numbers its own.
+    """
+
+    def __init__(self, container, pool):
+        self.container = container
+        self.pool = pool
+        # versions the pool and workers see, unique across every connection
+        self.versions = itertools.count(1)
+
+    async def handle(self, reader, writer):
+        """One bot connection, for as long as it stays open"""
+        preambles = collections.OrderedDict()
+        tasks = {}
+        slots = asyncio.Semaphore(MAX_INFLIGHT_PER_CONNECTION)
+
+        def send(header, body=b""):
+            header = json.dumps(header).encode()
+            writer.writelines([FRAME.pack(len(header), len(body)), header, body])
+
+        def finished(request_id, task):
+            if tasks.get(request_id) is task:
+                del tasks[request_id]
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    print(f"Bot sent garbage: {e}")
+                    continue
+
+                op = request.get("op")
+                if op == "preamble":
+                    preambles[request["version"]] = Preamble(next(self.versions), request["snippets"])
+                    preambles.move_to_end(request["version"])
+                    while len(preambles) > PREAMBLES_PER_CONNECTION:
+                        preambles.popitem(last=False)
+                elif op == "cancel":
+                    task = tasks.get(request.get("id"))
+                    if task is not None:
+                        task.cancel()
+                elif op == "reset_session":
+                    await self.pool.reset_session(request.get("session"))
+                elif op == "reset_sessions":
+                    await self.pool.reset_sessions(request.get("prefix", ""))
+                elif op == "stats":
+                    send({"id": request.get("id"), "stats": self.pool.stats()})
+                elif len(tasks) >= MAX_INFLIGHT_PER_CONNECTION + MAX_WAITING_PER_CONNECTION:
+                    send({"id": request.get("id"), "failed": "queue_full",
+                          "message": f"{len(tasks)} runs from this bot already in flight"})
+                else:
+                    task = asyncio.create_task(self.run(request, preambles, send, writer, slots))
+                    tasks[request.get("id")] = task
+                    task.add_done_callback(lambda t, request_id=request.get("id"): finished(request_id, t))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # the bot is gone, nobody is going to read the answers
+            for task in list(tasks.values()):
+                task.cancel()
+            writer.close()
+
+    async def run(self, request, preambles, send, writer, slots):
+        # backpressure: a connection only gets MAX_INFLIGHT_PER_CONNECTION runs into the pool at once
+        async with slots:
+            await self._run(request, preambles, send, writer)
+
+    async def _run(self, request, preambles, send, writer):
+        request_id = request.get("id")
+        version = request.get("preamble")
+        if version is not None and version not in preambles:
+            send({"id": request_id, "missing_preamble": version})
+            return
+
+        if "batch" in request:
+            lua_code = Batch(request["batch"], request.get("chained"))
+        elif request.get("profile"):
+            lua_code = Profile(request.get("code", ""))
+        else:
+            lua_code = request.get("code", "")
+
+        def on_output(text):
+            send({"id": request_id, "chunk": True}, text.encode("utf-8", "replace"))
+
+        try:
+            if not await self.container.ensure_running():
+                raise WorkerError("Execution container is down")
+            result = await self.pool.run(lua_code, preambles.get(version), request.get("timeout", TIMEOUT),
+                                         request.get("guild"), request.get("user"), on_output, request.get("session"),
+                                         request.get("engine"))
+        except QueueFull as e:
+            send({"id": request_id, "failed": "queue_full", "message": str(e)})
+        except asyncio.TimeoutError:
+            send({"id": request_id, "failed": "timeout", "message": "Execution timed out"})
+        except WorkerError as e:
+            # maybe the worker crashed, maybe the whole container went away, find out before the next run
+            self.container.mark_suspect()
+            send({"id": request_id, "failed": "worker_error", "message": str(e)})
+        except FileNotFoundError:
+            send({"id": request_id, "failed": "worker_error", "message": "Podman not found on the executor"})
+        else:
+            result["id"] = request_id
+            send(result, pack_outputs(result))
+
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+async def start_server(handle, address):
+    kind, *where = parse_address(address)
+    if kind == "unix":
+        return await asyncio.start_unix_server(handle, where[0], limit=STREAM_LIMIT)
+    return await asyncio.start_server(handle, *where, limit=STREAM_LIMIT)
+
+
+async def serve(addresses):
+    """Bring up the container and workers, then answer bots until interrupted"""
+    container, pool = local_executor()
+    service = ExecutorService(container, pool)
+    container.watch()
+    if await container.ensure_running():
+        await pool.warm()
+
+    servers = [await start_server(service.handle, address) for address in addresses]
+    print(f"Executor listening on {', '.join(addresses)}")
+    try:
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+    finally:
+        for server in servers:
+            server.close()
+        await pool.stop()
+        await container.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--listen", action="append",
+                        help="unix:<path> or <host>:<port>, can be given more than once (default 127.0.0.1:7100)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.listen or ["127.0.0.1:7100"]))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import asyncio
+import collections
+import itertools
+import json
+import os
+import sqlite3
+import threading
+from executor import Preamble
+
+
+class ResponseIndex:
+    """message id -> bot response id, small LRU in memory backed by SQLite with write-behind batching"""
+
+    def __init__(self, path, max_cached=5000, max_rows=200000, flush_interval=2.0):
+        self.path = path
+        self.max_cached = max_cached
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.cache = collections.OrderedDict()
+        # message id -> response id, or None for a delete, waiting to be written
+        self.dirty = {}
+        self.flush_task = None
+        # one connection shared by the worker threads, sqlite is fine with that as long as it's one at a time
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (message_id INTEGER PRIMARY KEY, response_id INTEGER NOT NULL)")
+        self.db.commit()
+
+    def _remember(self, message_id, response_id):
+        self.cache[message_id] = response_id
+        self.cache.move_to_end(message_id)
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+    async def get(self, message_id):
+        """Response id for message_id, or None"""
+        if message_id in self.dirty:
+            return self.dirty[message_id]
+        if message_id in self.cache:
+            self.cache.move_to_end(message_id)
+            return self.cache[message_id]
+
+        response_id = await asyncio.to_thread(self._load, message_id)
+        if response_id is not None:
+            self._remember(message_id, response_id)
+        return response_id
+
+    def _load(self, message_id):
+        with self.lock:
+            row = self.db.execute("SELECT response_id FROM responses WHERE message_id = ?", (message_id,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, message_id, response_id):
+        self._remember(message_id, response_id)
+        self.dirty[message_id] = response_id
+        self._schedule_flush()
+
+    def pop(self, message_id):
+        self.cache.pop(message_id, None)
+        self.dirty[message_id] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        dirty, self.dirty = self.dirty, {}
+        try:
+            await asyncio.to_thread(self._write, dirty)
+        except Exception as e:
+            print(f"Error saving responses: {e}")
+
+    def _write(self, dirty):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO responses (message_id, response_id) VALUES (?, ?)",
+                                [(m, r) for m, r in dirty.items() if r is not None])
+            self.db.executemany("DELETE FROM responses WHERE message_id = ?",
+                                [(m,) for m, r in dirty.items() if r is None])
+            # message ids are discord snowflakes, they go up with time, so keep the newest max_rows messages.
+            # with fewer rows than that the subquery is NULL and nothing goes
+            self.db.execute("DELETE FROM responses WHERE message_id < "
+                            "(SELECT message_id FROM responses ORDER BY message_id DESC LIMIT 1 OFFSET ?)",
+                            (self.max_rows - 1,))
+            self.db.commit()
+
+    def close(self):
+        """Write out anything still pending, call this on shutdown"""
+        dirty, self.dirty = self.dirty, {}
+        if dirty:
+            self._write(dirty)
+        with self.lock:
+            self.db.close()
+
+
+# where the old single preamble.json goes, guilds that never edited their own preamble keep using it
+SHARED = -1
+# direct messages have no guild
+DIRECT = 0
+
+
+class PreambleStore:
+    """Preamble snippets per guild, kept in memory and appended to a SQLite log that gets compacted now and then
+
+    Also keeps a few plain per-guild settings (like the engine) in a table next to it.
+    """
+
+    def __init__(self, path, compact_after=500):
+        self.path = path
+        self.compact_after = compact_after
+        # guild -> snippets, a guild is only in here once it has its own preamble (which may be empty)
+        self.guilds = {}
+        # guild -> Preamble snapshot (or None if empty), dropped on every change
+        self.snapshots = {}
+        # guild -> {name: value}
+        self.settings = {}
+        self.versions = itertools.count(1)
+        self.log_rows = 0
+        # the log is compacted once it grows past this
+        self.compact_at = compact_after
+        # keeps log writes in the order the changes were made
+        self.write_lock = asyncio.Lock()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # op is "init" (guild gets its own empty preamble), "add" (code appended) or "del" (position removed)
+        self.db.execute("CREATE TABLE IF NOT EXISTS preamble_log (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "guild_id INTEGER NOT NULL, op TEXT NOT NULL, position INTEGER, code TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS guild_settings (guild_id INTEGER NOT NULL, name TEXT NOT NULL, "
+                        "value TEXT NOT NULL, PRIMARY KEY (guild_id, name))")
+        self.db.commit()
+
+    @staticmethod
+    def _replay(rows):
+        guilds = {}
+        for guild, op, position, code in rows:
+            snippets = guilds.setdefault(guild, [])
+            if op == "add":
+                snippets.append(code)
+            elif op == "del" and 0 <= position < len(snippets):
+                snippets.pop(position)
+        return guilds
+
+    def load(self, legacy_file=None):
+        """Read the log into memory, blocking, the first load also imports the old preamble.json if there is one"""
+        with self.lock:
+            rows = self.db.execute("SELECT guild_id, op, position, code FROM preamble_log ORDER BY seq").fetchall()
+            settings = self.db.execute("SELECT guild_id, name, value FROM guild_settings").fetchall()
+        self.guilds = self._replay(rows)
+        self.snapshots = {}
+        self.log_rows = len(rows)
+        self.settings = {}
+        for guild, name, value in settings:
+            self.settings.setdefault(guild, {})[name] = value
+
+        if not rows and legacy_file and os.path.exists(legacy_file):
+            try:
+                with open(legacy_file) as f:
+                    legacy = json.load(f)
+                ops = [(SHARED, "init", None, None)] + [(SHARED, "add", None, code) for code in legacy]
+                self._append(ops)
+                self.guilds = {SHARED: list(legacy)}
+                print(f"Imported {len(legacy)} preamble snippet(s) from {legacy_file}")
+            except Exception as e:
+                print(f"Error importing preamble: {e}")
+
+    @staticmethod
+    def key(guild_id):
+        return DIRECT if guild_id is None else guild_id
+
+    def snippets(self, guild_id):
+        """Snippets that run before code in this guild"""
+        key = self.key(guild_id)
+        return self.guilds.get(key if key in self.guilds else SHARED, [])
+
+    def get(self, guild_id):
+        """Versioned Preamble for this guild, None if it has no snippets"""
+        key = self.key(guild_id)
+        if key not in self.guilds:
+            key = SHARED
+        if key not in self.snapshots:
+            snippets = self.guilds.get(key)
+            self.snapshots[key] = Preamble(next(self.versions), snippets) if snippets else None
+        return self.snapshots[key]
+
+    def _own(self, key):
+        """Give the guild its own preamble, starting from the shared one, returns the log ops for that"""
+        if key in self.guilds:
+            return []
+        shared = self.guilds.get(SHARED, [])
+        self.guilds[key] = list(shared)
+        return [(key, "init", None, None)] + [(key, "add", None, code) for code in shared]
+
+    async def add(self, guild_id, code):
+        """Append a snippet, returns its number"""
+        key = self.key(guild_id)
+        ops = self._own(key) + [(key, "add", None, code)]
+        self.guilds[key].append(code)
+        self.snapshots.pop(key, None)
+        await self._write(ops)
+        return len(self.guilds[key]) - 1
+
+    async def delete(self, guild_id, position):
+        """Remove snippet number position, returns its code"""
+        key = self.key(guild_id)
+        ops = self._own(key) + [(key, "del", position, None)]
+        code = self.guilds[key].pop(position)
+        self.snapshots.pop(key, None)
+        await self._write(ops)
+        return code
+
+    def setting(self, guild_id, name, default=None):
+        return self.settings.get(self.key(guild_id), {}).get(name, default)
+
+    async def set_setting(self, guild_id, name, value):
+        """Change a guild setting, None goes back to the default"""
+        key = self.key(guild_id)
+        if value is None:
+            self.settings.get(key, {}).pop(name, None)
+        else:
+            self.settings.setdefault(key, {})[name] = value
+        async with self.write_lock:
+            try:
+                await asyncio.to_thread(self._save_setting, key, name, value)
+            except Exception as e:
+                print(f"Error saving setting: {e}")
+
+    def _save_setting(self, key, name, value):
+        with self.lock:
+            if value is None:
+                self.db.execute("DELETE FROM guild_settings WHERE guild_id = ? AND name = ?", (key, name))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO guild_settings (guild_id, name, value) VALUES (?, ?, ?)",
+                                (key, name, value))
+            self.db.commit()
+
+    async def _write(self, ops):
+        # memory is already up to date, the log only has to catch up without holding up the event loop
+        async with self.write_lock:
+            try:
+                await asyncio.to_thread(self._append, ops)
+            except Exception as e:
+                print(f"Error saving preamble: {e}")
+
+    def _append(self, ops):
+        with self.lock:
+            self.db.executemany("INSERT INTO preamble_log (guild_id, op, position, code) VALUES (?, ?, ?, ?)", ops)
+            self.db.commit()
+            self.log_rows += len(ops)
+            if self.log_rows > self.compact_at:
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the log as one init + adds per guild, in a single transaction so a crash keeps the old log"""
+        # built from the log itself, memory can already hold changes that are still waiting to be written
+        rows = self.db.execute("SELECT guild_id, op, position, code FROM preamble_log ORDER BY seq").fetchall()
+        guilds = self._replay(rows)
+        ops = []
+        for guild, snippets in guilds.items():
+            ops.append((guild, "init", None, None))
+            ops += [(guild, "add", None, code) for code in snippets]
+        self.db.execute("DELETE FROM preamble_log")
+        self.db.executemany("INSERT INTO preamble_log (guild_id, op, position, code) VALUES (?, ?, ?, ?)", ops)
+        self.db.commit()
+        self.log_rows = len(ops)
+        self.compact_at = len(ops) + self.compact_after
+
+    def close(self):
+        with self.lock:
+            self.db.close()